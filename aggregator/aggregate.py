@@ -1,12 +1,28 @@
 import argparse
+import contextlib
+import cProfile
 import os
+import shutil
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+from itertools import islice, repeat
 from pprint import pprint
 
 import pandas as pd
 pd.options.display.width=None
 
-from aggregator.utilities import schema_map
+from aggregator.cache import ManifestCache
+from aggregator.discovery import CSV_PATTERNS, PartitionFilter, discover_csvs
+from aggregator.errors import ErrorLog, open_error_sink
+from aggregator.schema import configure_value_caches, value_cache_info
+from aggregator.stats import Stats
+from aggregator.utilities import (schema_map, df_memory_mb, detect_compression, compact_dtypes,
+                                  match_columns, COMPRESSION_EXTENSIONS)
+from aggregator.writers import OUTPUT_FORMATS, PartitionedWriter, read_output, read_partitions
+
+# columns added to rejected rows in a quarantine output
+QUARANTINE_COLUMNS = ['_csv_path', '_row', '_errors']
 
 
 class AggCSV:
@@ -15,47 +31,211 @@ class AggCSV:
     Creates pandas dataframe from provided csv to validate.
     """
 
-    def __init__(self, insurance_type = None, csv = None, schema_cols =None):
-        self.df = self.pandas_read_csv(csv) if csv else None
+    def __init__(self, insurance_type = None, csv = None, schema_cols =None, chunksize=None):
         self.insurance_type = insurance_type
         self.csv_path = csv
         self.schema_cols = schema_cols
+        self.chunksize = chunksize
         self.rows_w_errors = set()
         self.distinct_cols_w_errors = set()
         self.errors = None
+        self.err_df = None
+        self.quarantine_reason = None
+        self.stats = Stats()
+        # in streaming mode the csv is read chunk by chunk in validate_chunks
+        self.df = self._read_csv() if csv and not chunksize else None
+
+    def _read_csv(self):
+        """ read the csv whole, timing it """
+        with self.stats.timer('read', self.csv_path):
+            df = self.pandas_read_csv(self.csv_path, usecols=self.schema_cols)
+        self.stats.add('read', rows=len(df), csv=self.csv_path)
+        return df
 
-    def pandas_read_csv(self, csv, sep=',', encoding='utf-8', dtype=str):
+    def pandas_read_csv(self, csv, sep=',', encoding='utf-8', dtype=str, chunksize=None, usecols=None):
         """
         Read in CSV as a pandas dataframe for manipulation
         lineterminator is not specified for csvs to pandas dataframe currently
 
         dtype=str prevents string to number pandas conversions
+        chunksize returns an iterator of dataframes of that many rows,
+            row labels continue from one chunk to the next
+        gzip, bz2, zstd, xz and zip compressed csvs are detected from
+            their leading bytes and decompressed as they are read
+        usecols, a list of schema column names, reads only those columns.
+            Headers are matched ignoring case, spaces and punctuation, and
+            renamed to the schema names, other columns are never parsed.
         """
-        return pd.read_csv(csv, sep=sep, encoding=encoding, dtype=dtype)
+        compression = detect_compression(csv)
+        kwargs = {'sep':sep, 'encoding':encoding, 'compression':compression}
+        if usecols is None:
+            return pd.read_csv(csv, dtype=dtype, chunksize=chunksize, **kwargs)
+
+        headers = pd.read_csv(csv, nrows=0, **kwargs).columns
+        names = match_columns(headers, usecols)
+        df = pd.read_csv(csv, dtype=dtype, chunksize=chunksize, usecols=list(names), **kwargs)
+        if chunksize:
+            return (chunk.rename(columns=names) for chunk in df)
+        return df.rename(columns=names)
 
-    def validate(self):
+    def validate(self, vectorized=False, dedup=False, max_error_rate=None, max_errors=None,
+                 sample_rows=1000, sample_only=False):
         """
         Apply standard and defined column validations for specified schema class.
         Record error data in Schema object and return
+
+        vectorized=True validates each column as a whole Series instead of
+            cell by cell, with the same cleaned output and errors
+        dedup=True validates each distinct value of a column once, which
+            is much faster for low cardinality columns
+        max_error_rate (a fraction of rows) and max_errors (a count of rows)
+            are an error budget. A random sample of sample_rows rows is
+            validated first, and the csv is quarantined without validating
+            the rest if the sample is over budget, as it is if the whole
+            csv is. A csv missing schema columns is always quarantined.
+        sample_only=True validates only the sample, for a quick check
         """
-        
+        self._reset_errors()
+        budget = (max_error_rate, max_errors)
+        if self._quarantine_missing_columns(self.df):
+            return
+        if sample_only:
+            self.df = self._sample(self.df, sample_rows)
+        elif budget != (None, None) and len(self.df) > sample_rows:
+            sample = self._sample(self.df, sample_rows)
+            if self._quarantine_over_budget(self._sample_errors(sample, vectorized, dedup),
+                                            len(sample), *budget):
+                return
+
+        rows = len(self.df)
+        self.err_df = self._validate_chunk(vectorized, dedup)
+        self._quarantine_over_budget(len(self.rows_w_errors), rows, *budget)
+
+    def validate_chunks(self, vectorized=False, dedup=False, max_error_rate=None, max_errors=None,
+                        sample_rows=1000, sample_only=False):
+        """
+        Streaming version of validate for csvs too large to hold in memory.
+        Read and validate the csv chunksize rows at a time, yielding each
+            chunk with its error rows removed. Row labels continue across
+            chunks, so errors refer to rows of the whole csv.
+        Errors are collected from all chunks once the generator is exhausted.
+        The error budget is checked on the first sample_rows rows before
+            any chunk is yielded, and sample_only validates just those rows.
+        """
+        self._reset_errors()
+        budget = (max_error_rate, max_errors)
+        err_dfs = []
+        chunks = iter(self.pandas_read_csv(self.csv_path, chunksize=self.chunksize, usecols=self.schema_cols))
+        first = True
+        while True:
+            with self.stats.timer('read', self.csv_path):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            self.stats.add('read', rows=len(chunk), csv=self.csv_path)
+
+            if first:
+                first = False
+                sample = chunk.head(sample_rows)
+                if self._quarantine_missing_columns(chunk):
+                    return
+                if sample_only:
+                    chunk = sample
+                elif budget != (None, None):
+                    if self._quarantine_over_budget(self._sample_errors(sample, vectorized, dedup),
+                                                    len(sample), *budget):
+                        return
+
+            self.df = chunk
+            err_dfs.append(self._validate_chunk(vectorized, dedup))
+            yield self.df
+            if sample_only:
+                break
+        self.err_df = pd.concat(err_dfs) if err_dfs else pd.DataFrame(columns=self.schema_cols)
+
+    def _sample(self, df, sample_rows):
+        """ return a random sample of at most sample_rows rows of df, in order """
+        if len(df) <= sample_rows:
+            return df
+        return df.sample(sample_rows, random_state=0).sort_index()
+
+    def _sample_errors(self, sample, vectorized, dedup):
+        """ return the number of rows of sample with errors, without recording them """
         schm = schema_map(self.insurance_type)
-        for _, v in schm.get_schema_attrs():
-            col = v['name']
-            # apply standard validations
-            for validation in schm.get_std_validations():
-                self.df[col] = self.df[col].apply(lambda x: validation(x, v, self.csv_path, self.df))
-                schm.set_row(0)
-            # apply specific validations
-            for validation in v['validations']:
-                self.df[col] = self.df[col].apply(lambda x: validation(schm, x, v, self.csv_path, self.df))
-                schm.set_row(0)
+        with self.stats.timer('sample', self.csv_path, len(sample)):
+            for column in schm.get_plan().columns:
+                schm.validate_series(sample[column.name], column.col, self.csv_path, vectorized, dedup)
+        return len(schm.get_rows_w_errors())
+
+    def _quarantine_missing_columns(self, df):
+        """ quarantine the csv if df is missing schema columns, e.g. from a wrong delimiter """
+        columns = [c.name for c in schema_map(self.insurance_type).get_plan().columns]
+        missing = [c for c in columns if c not in df.columns]
+        if missing:
+            self._quarantine('missing columns ' + ', '.join(missing))
+        return bool(missing)
+
+    def _quarantine_over_budget(self, rows_w_errors, rows, max_error_rate, max_errors):
+        """ quarantine the csv if rows_w_errors of rows are over the error budget """
+        reason = None
+        if max_errors is not None and rows_w_errors > max_errors:
+            reason = f'{rows_w_errors} rows with errors, more than {max_errors}'
+        elif max_error_rate is not None and rows and rows_w_errors / rows > max_error_rate:
+            reason = (f'{rows_w_errors / rows:.1%} of {rows} rows with errors, '
+                      f'more than {max_error_rate:.1%}')
+        if reason:
+            self._quarantine(reason)
+        return reason is not None
+
+    def _quarantine(self, reason):
+        """
+        Reject the whole csv: none of its rows are combined, and its
+            errors are replaced by the reason it was quarantined
+        """
+        self._reset_errors()
+        self.quarantine_reason = reason
+        self.df = pd.DataFrame(columns=self.schema_cols)
+        self.err_df = pd.DataFrame(columns=self.schema_cols)
+
+    def _reset_errors(self):
+        self.quarantine_reason = None
+        self.rows_w_errors = set()
+        self.distinct_cols_w_errors = set()
+        self.errors = ErrorLog()
+
+    def _validate_chunk(self, vectorized, dedup):
+        """
+        Validate all rows of self.df and add their errors to the totals.
+        Remove rows with errors from self.df and return them.
+        """
+        schm = schema_map(self.insurance_type)
+        with self.stats.timer('validate', self.csv_path):
+            for column in schm.get_plan().columns:
+                col = column.name
+                self.df[col] = schm.validate_series(self.df[col], column.col, self.csv_path, vectorized, dedup)
+        self.stats.add('validate', rows=len(self.df), csv=self.csv_path)
+        self.stats.update(schm.get_stats())
 
         # retrieve data from schema object and remove errors rows from self.df
-        self.rows_w_errors = schm.get_rows_w_errors()
-        self.distinct_cols_w_errors = schm.get_distinct_cols_w_errors()
-        self.errors = schm.get_errors()
-        self.df.drop(index=self.rows_w_errors, inplace=True)
+        rows = schm.get_rows_w_errors()
+        self.rows_w_errors.update(rows)
+        self.distinct_cols_w_errors.update(schm.get_distinct_cols_w_errors())
+        self.errors.update(schm.get_errors())
+        with self.stats.timer('error_rows', self.csv_path, len(rows)):
+            err_df = self._error_rows(rows, schm.get_errors())
+            self.df.drop(index=rows, inplace=True)
+        return err_df
+
+    def _error_rows(self, rows, errors):
+        """
+        Fetch all rows with errors from self.df in a single lookup,
+            showing the value that failed validation in each errored cell
+        """
+        err_df = self.df.loc[sorted(rows)].astype(object)
+        first_errs = errors.to_frame().drop_duplicates(['row', 'column'])
+        for col, errs in first_errs.groupby('column', sort=False):
+            err_df.loc[errs['row'], col] = errs['value'].values
+        return err_df
 
     def _just_str(self, my_str, val):
         """ justify a number for use in self.print_errors """
@@ -64,16 +244,18 @@ class AggCSV:
         out = my_str  + ' '*(just-str_len) + ': ' + str(val)
         return out
 
-    def _csv_summary_info(self, rows, cols, line):
+    def _csv_summary_info(self, line):
         """ print out formatted csv summary error info """
         print(self._just_str('CSV Name', self.csv_path))
         print(self._just_str('Total Rows with Errors', len(self.rows_w_errors)))
         print(self._just_str('Total Distinct Columns with Errors', len(self.distinct_cols_w_errors)))
         print(line)
 
-    def print_errors(self):
+    def print_errors(self, max_rows=None):
         """
         Print errors collected from Valiation/GeneralSchema objects to console
+        max_rows prints a sample of at most that many rows with errors,
+            formatting a wide dataframe to the console is slow
         """
         # vars for print formatting
         df_length = 100
@@ -81,24 +263,18 @@ class AggCSV:
         line = '-'*df_length
         print('\n' + header_line)
 
-        # create a dataframe of errors, with no duplicate rows
-        err_df = pd.DataFrame(columns = self.schema_cols)
-        cols = set()
-        rows = []
-        # individual rows with errors by csv
-        for err in self.errors:
-            row = err[2]
-            cols.add(err[1])
-            if row in rows:
-                pass
-            else:
-                rows.append(row)
-                err_df = pd.concat([err_df, err[5]])
+        # rows with errors were fetched once, deduplicated and sorted, by
+        # validate; order schema columns first, followed by any extras
+        cols = list(self.schema_cols or [])
+        cols += [c for c in self.err_df.columns if c not in cols]
         # print summary info about csv and error df
-        if len(err_df) > 0:
-            self._csv_summary_info(rows, cols, line)
-            err_df = err_df.sort_index()
-            print(err_df, '\n\n')
+        if len(self.err_df) > 0:
+            self._csv_summary_info(line)
+            err_df = self.err_df
+            if max_rows is not None and len(err_df) > max_rows:
+                err_df = err_df.sample(max_rows, random_state=0).sort_index()
+                print(f'Showing a sample of {max_rows} of {len(self.err_df)} rows with errors')
+            print(err_df.reindex(columns=cols), '\n\n')
 
     def get_df(self):
         return self.df
@@ -110,62 +286,403 @@ class AggCSV:
         return self.rows_w_errors
 
 
+def _validate_csv(csv, insurance_type, schema_cols, chunksize, validate_kwargs):
+    """
+    Read and validate a single csv, returning its AggCSV.
+    Defined at module level so it can be run in a Combine worker process.
+    """
+    a = AggCSV(insurance_type, csv, schema_cols, chunksize)
+    if chunksize:
+        # a quarantined csv yields no chunks, and keeps the empty a.df it was given
+        chunks = list(a.validate_chunks(**validate_kwargs))
+        if chunks:
+            a.df = pd.concat(chunks)
+    else:
+        a.validate(**validate_kwargs)
+    return a
+
+
 class Combine:
     """
     Given an input list of CSVs, convert the files into 
     a single CSV that matches an expected output schema.
     """
 
-    def __init__(self, insurance_type = None, csvs_path=None):
+    def __init__(self, insurance_type = None, csvs_path=None, vectorized=False, *, workers=1,
+                 chunksize=None, cache_dir=None, value_cache_size=None, dedup=False,
+                 output_format='csv', compression=None, row_group_size=None, compact=False,
+                 string_dtype=None, error_output=None, print_errors=True, error_sample=None,
+                 max_printed_errors=None, max_error_rate=None, max_errors=None, sample_rows=1000,
+                 sample_only=False, quarantine_output=None, pattern=None, prefetch=2,
+                 recursive=False, partition_filters=(), partition_by=None):
         s = schema_map(insurance_type)
-        self.schema_cols = [v['name'] for _,v in s.get_schema_attrs()]
+        if value_cache_size is not None:
+            configure_value_caches(value_cache_size)
+        self.plan = s.get_plan()
+        self.schema_cols = [c.name for c in self.plan.columns]
         self.master_df = pd.DataFrame(columns=self.schema_cols)
         self.insurance_type = insurance_type
         self.csvs_path = csvs_path
+        # keyword arguments for AggCSV.validate
+        self.validate_kwargs = {'vectorized':vectorized, 'dedup':dedup,
+                                'max_error_rate':max_error_rate, 'max_errors':max_errors,
+                                'sample_rows':sample_rows, 'sample_only':sample_only}
+        self.workers = workers
+        self.chunksize = chunksize
+        # only file names matching pattern (a glob) are combined, from
+        # subdirectories too if recursive, skipping key=value partition
+        # directories that don't pass partition_filters, e.g. 'date>=2024-01-01'
+        self.patterns = (pattern,) if pattern else CSV_PATTERNS
+        self.recursive = recursive
+        self.partition_filters = [PartitionFilter.parse(f) if isinstance(f, str) else f
+                                  for f in partition_filters]
+        # csvs read ahead on a thread pool while the current one validates
+        self.prefetch = prefetch
+        self.output_format = output_format
+        self.compression = compression
+        self.row_group_size = row_group_size
+        # write one file per value of this column, see PartitionedWriter
+        self.partition_by = partition_by
+        # convert master_df to schema typed, compact dtypes once combined
+        self.compact = compact
+        self.string_dtype = string_dtype
+        self.memory_mb_before_compact = None
+        # time and rows of each stage, including those of every AggCSV
+        self.stats = Stats()
+        # errors are written to error_output (.jsonl or .parquet) as each
+        # csv is validated; the console shows at most error_sample rows
+        # with errors per csv and max_printed_errors in total
+        self.error_output = error_output
+        self.print_errors = print_errors
+        self.error_sample = error_sample
+        self.max_printed_errors = max_printed_errors
+        self.total_printed_errors = 0
+        self.printed_errors_limited = False
+        # the error budget changes which csvs are quarantined, and a sample
+        # only run never validates whole csvs, so neither can reuse the cache
+        budget = ''
+        if (max_error_rate, max_errors) != (None, None):
+            budget = f'-{max_error_rate}-{max_errors}-{sample_rows}'
+        self.cache = ManifestCache(cache_dir, self.plan.version + budget) if cache_dir and not sample_only else None
+        self.sample_only = sample_only
         self.total_csvs = 0
+        self.total_csvs_cached = 0
+        self.total_rows = 0
         self.total_csvs_w_errors = 0
         self.total_rows_w_errors = 0
         self.distinct_cols_w_errors = set()
+        # csv path -> reason it was quarantined
+        self.quarantined_csvs = {}
+        # rejected rows are written to quarantine_output (.csv or .parquet)
+        self.quarantine_output = quarantine_output
 
     def combine_csvs(self):
         """
         Combine all csvs in indicated path to a single dataframe
         Printing out errors from each CSV as its processed minimizes
             in-memory error cache containing dataframes
+        Validated dataframes are collected and concatenated once, so
+            combining grows linearly with the number of files
+        With compact, master_df columns are converted to the schema's
+            declared types, with low cardinality strings as categoricals
+        """
+        frames = [self.master_df]
+        self._combine(frames.append)
+
+        # add validated dataframes to master df in a single concat
+        with self.stats.timer('concat', rows=sum(map(len, frames))):
+            self.master_df = pd.concat(frames, ignore_index=True)
+        if self.compact:
+            self.memory_mb_before_compact = df_memory_mb(self.master_df)
+            with self.stats.timer('compact', rows=len(self.master_df)):
+                self.master_df = compact_dtypes(self.master_df, self._types(),
+                                                string_dtype=self.string_dtype)
+
+    def stream_combined_csv(self, output_location='.'):
+        """
+        Combine and write all csvs in indicated path in a single pass.
+        Each validated csv, or chunk of a csv, is appended to the output
+            as soon as it is clean instead of being held in self.master_df,
+            so memory is bounded by the largest csv (or chunk).
+        """
+        path = self._output_path(output_location)
+        with self._open_writer(path) as writer:
+            def write(df):
+                with self.stats.timer('write', rows=len(df)):
+                    writer.write(df)
+            self._combine(write)
+        self._print_output_path(path)
+
+    def _combine(self, write):
+        """
+        Validate all csvs in indicated path, passing each validated
+            dataframe to write and updating totals
+        """
+        self._combine_validated(self._validated_csvs(self._list_csvs()), write)
+
+    def _list_csvs(self):
         """
-        for csv in os.listdir(self.csvs_path):
-            # validate/standardize data
-            a = AggCSV(self.insurance_type, self.csvs_path + '/' + csv, self.schema_cols)
-            a.validate()
-
-            # drop columns from AggCSV df not in defined schema, and add to master df
-            drop_columns = [c for c in a.get_df().columns if c not in self.schema_cols]
-            temp_df = a.get_df().drop(columns = drop_columns)
-            self.master_df.reset_index(drop=True, inplace=True)
-            self.master_df = pd.concat([self.master_df, temp_df])
-
-            # print out rows w errors, update totals
-            a.print_errors()
-            self.total_csvs += 1
-            self.total_csvs_w_errors += 1 if len(a.get_rows_w_errors()) > 0 else 0
-            self.total_rows_w_errors += len(a.get_rows_w_errors())
-            self.distinct_cols_w_errors.update(a.get_distinct_cols_w_errors())
-    
+        Return paths of files in self.csvs_path, which may be a glob, whose
+            names match self.patterns, sorted. Hidden files (like temporary
+            outputs) and other files are skipped, see discovery.discover_csvs.
+        """
+        return discover_csvs(self.csvs_path, self.patterns, self.recursive, self.partition_filters)
+
+    def _combine_validated(self, validated, write):
+        """
+        Pass validated dataframes of each AggCSV and its iterable of
+            dataframes in validated to write, updating totals and writing
+            errors and rejected rows to their outputs
+        """
+        sink = open_error_sink(self.error_output) if self.error_output else contextlib.nullcontext()
+        quarantine = self._open_quarantine() if self.quarantine_output else contextlib.nullcontext()
+        with sink, quarantine:
+            for a, chunks in validated:
+                # drop any columns not in defined schema, csvs are already
+                # read with only schema columns unless loaded from an old cache
+                for df in chunks:
+                    drop_columns = [c for c in df.columns if c not in self.schema_cols]
+                    write(df.drop(columns = drop_columns))
+                    self.total_rows += len(df)
+
+                self.total_csvs += 1
+                if a.quarantine_reason:
+                    self.quarantined_csvs[a.csv_path] = a.quarantine_reason
+                    print(f'\nQuarantined {a.csv_path}: {a.quarantine_reason}')
+                    self.stats.update(a.stats)
+                    continue
+
+                # write and print out rows w errors, update totals
+                if self.error_output:
+                    with self.stats.timer('error_output', a.csv_path, len(a.errors)):
+                        sink.write(a.errors)
+                if self.quarantine_output and len(a.err_df):
+                    with self.stats.timer('quarantine_output', a.csv_path, len(a.err_df)):
+                        quarantine.write(self._quarantine_rows(a))
+                with self.stats.timer('print_errors', a.csv_path, len(a.get_rows_w_errors())):
+                    self._print_errors(a)
+                self.stats.update(a.stats)
+                self.total_csvs_w_errors += 1 if len(a.get_rows_w_errors()) > 0 else 0
+                self.total_rows_w_errors += len(a.get_rows_w_errors())
+                self.distinct_cols_w_errors.update(a.get_distinct_cols_w_errors())
+
+    def _open_quarantine(self):
+        """ return a writer for rejected rows, chosen by quarantine_output's extension """
+        ext = os.path.splitext(self.quarantine_output)[1].lstrip('.')
+        if ext not in OUTPUT_FORMATS:
+            raise ValueError(f'Quarantine output {self.quarantine_output} must end in one of: '
+                             + ', '.join('.' + e for e in sorted(OUTPUT_FORMATS)))
+        return OUTPUT_FORMATS[ext](self.quarantine_output, self.schema_cols + QUARANTINE_COLUMNS)
+
+    def _quarantine_rows(self, a):
+        """
+        Return rejected rows of AggCSV a as strings, with the csv and row
+            they came from and the column:rule of each of their errors.
+            Rows reingested from a quarantine output keep the csv and row
+            they were first rejected from.
+        """
+        errors = a.errors.to_frame().drop_duplicates(['row', 'column', 'rule'])
+        labels = (errors['column'] + ':' + errors['rule']).groupby(errors['row'].astype(int)).agg('; '.join)
+        df = a.err_df.reindex(columns=self.schema_cols).astype(object)
+        df = df.where(df.notna(), None).applymap(lambda v: v if v is None else str(v))
+        source = a.err_df.reindex(columns=['_csv_path', '_row'])
+        df['_csv_path'] = source['_csv_path'].fillna(a.csv_path)
+        df['_row'] = source['_row'].fillna(pd.Series(a.err_df.index.astype(str), index=a.err_df.index))
+        df['_errors'] = labels.reindex(a.err_df.index.astype(int)).values
+        return df
+
+    def reingest_quarantine(self, quarantine_path, output_location):
+        """
+        Validate rows of a quarantine output again, once they have been
+            corrected, and add those that pass to the combined output at
+            output_location, without rerunning the whole batch.
+        A csv combined output is copied and appended to, others (including
+            partitioned outputs) are rewritten, both in a temporary file that
+            replaces the output once complete, as the writers do.
+        Rows that still fail are written to self.quarantine_output, which
+            must be a different file.
+        output_location must be the combined output file, or its directory
+            when partitioned by self.partition_by.
+        """
+        if os.path.isdir(output_location) and not self.partition_by:
+            raise ValueError(f'Combined output {output_location} to reingest into must be a file, not a directory')
+        a = AggCSV(self.insurance_type, None, self.schema_cols)
+        a.csv_path = quarantine_path
+        # _csv_path and _row pass through validation, so rows that fail
+        # again are quarantined with the csv and row they came from
+        a.df = read_output(quarantine_path).drop(columns=['_errors'], errors='ignore')
+        a.validate(**self.validate_kwargs)
+
+        frames = [self.master_df]
+        self._combine_validated([(a, [a.get_df()])], frames.append)
+        self.master_df = pd.concat(frames, ignore_index=True)
+
+        path = output_location
+        with self.stats.timer('write', rows=len(self.master_df)):
+            if (self.output_format == 'csv' and not self.compression and not self.partition_by
+                and os.path.exists(path)):
+                out_dir, name = os.path.split(os.path.abspath(path))
+                tmp_path = os.path.join(out_dir, f'.{name}.{os.getpid()}.tmp')
+                shutil.copyfile(path, tmp_path)
+                try:
+                    with open(tmp_path, 'a', newline='', encoding='utf-8') as f:
+                        self.master_df.to_csv(f, index=False, header=False, columns=self.schema_cols)
+                except BaseException:
+                    os.remove(tmp_path)
+                    raise
+                os.replace(tmp_path, path)
+            else:
+                read = read_partitions if self.partition_by else read_output
+                combined = read(path) if os.path.exists(path) else None
+                with self._open_writer(path) as writer:
+                    if combined is not None:
+                        writer.write(combined)
+                    writer.write(self.master_df)
+        self._print_output_path(path)
+
+    def _print_errors(self, a):
+        """
+        Print errors of AggCSV a to the console, a sample of at most
+            self.error_sample rows, until self.max_printed_errors rows
+            with errors have been printed
+        """
+        if not self.print_errors or len(a.err_df) == 0:
+            return
+        max_rows = self.error_sample
+        if self.max_printed_errors is not None:
+            remaining = self.max_printed_errors - self.total_printed_errors
+            if remaining <= 0:
+                if not self.printed_errors_limited:
+                    print(f'\nPrinted {self.max_printed_errors} rows with errors, '
+                          'further errors are not printed')
+                    self.printed_errors_limited = True
+                return
+            max_rows = remaining if max_rows is None else min(max_rows, remaining)
+        a.print_errors(max_rows)
+        self.total_printed_errors += len(a.err_df) if max_rows is None else min(len(a.err_df), max_rows)
+
+    def _validated_csvs(self, csvs):
+        """
+        Yield an AggCSV for each csv, in the order given, along with an
+            iterable of its validated dataframes. Errors of an AggCSV are
+            complete once its dataframes have been consumed.
+        With a cache_dir, csvs unchanged since they were cached are loaded
+            from the cache and only new or changed csvs are validated.
+        """
+        cache = self.cache
+        cached = {csv for csv in csvs if cache and cache.is_cached(csv)}
+        validated = self._validate_csvs([csv for csv in csvs if csv not in cached])
+        for csv in csvs:
+            if csv in cached:
+                a = AggCSV(self.insurance_type, None, self.schema_cols)
+                a.csv_path = csv
+                self.total_csvs_cached += 1
+                yield a, cache.load(a)
+            elif cache:
+                a, chunks = next(validated)
+                yield a, cache.record(a, chunks)
+            else:
+                yield next(validated)
+        validated.close()
+
+    def _validate_csvs(self, csvs):
+        """
+        Yield an AggCSV for each csv, in the order given, along with an
+            iterable of its validated dataframes.
+        With more than one worker csvs are validated in a process pool,
+            results are still yielded in order so totals and the combined
+            output are the same as a serial run. A worker returns a whole
+            csv even with a chunksize, so memory is not bounded by it.
+        With a chunksize a serial run streams each csv chunk by chunk.
+        Otherwise a serial run reads up to self.prefetch csvs ahead on a
+            thread pool, overlapping reading with validation.
+        """
+        args = [csvs, repeat(self.insurance_type), repeat(self.schema_cols),
+                repeat(self.chunksize), repeat(self.validate_kwargs)]
+        if self.workers > 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                for a in pool.map(_validate_csv, *args):
+                    yield a, [a.get_df()]
+        elif self.chunksize:
+            for csv in csvs:
+                a = AggCSV(self.insurance_type, csv, self.schema_cols, self.chunksize)
+                yield a, a.validate_chunks(**self.validate_kwargs)
+        elif self.prefetch:
+            for a in self._prefetch_csvs(csvs):
+                a.validate(**self.validate_kwargs)
+                yield a, [a.get_df()]
+        else:
+            for a in map(_validate_csv, *args):
+                yield a, [a.get_df()]
+
+    def _prefetch_csvs(self, csvs):
+        """
+        Yield an AggCSV for each csv, in the order given, read on a thread
+            pool. At most self.prefetch csvs are read ahead of the one being
+            yielded, which bounds the memory they hold.
+        """
+        read = lambda csv: AggCSV(self.insurance_type, csv, self.schema_cols)
+        csvs = iter(csvs)
+        with ThreadPoolExecutor(max_workers=self.prefetch) as pool:
+            pending = deque(pool.submit(read, csv) for csv in islice(csvs, self.prefetch))
+            while pending:
+                a = pending.popleft().result()
+                for csv in islice(csvs, 1):
+                    pending.append(pool.submit(read, csv))
+                yield a
+
     def write_combined_csv(self, output_location='.'):
         """
         Write self.master_df to specified output location.
         Write to current working directory if none is provided.
+        Written as self.output_format, csv by default, or columnar
+            parquet/feather with the schema's declared types.
         """
-        date = datetime.today().strftime('%d%m%Y')
-        file_name = f'AggIns_combined_csvs_{date}.csv'
-        kwargs = {
-            'path_or_buf':file_name,
-            'index':False,
-            'header':True,
-            'columns':self.schema_cols
-        }
-        self.master_df.to_csv(**kwargs)
-        output_string = '\nCombined Aggregate Insurance Partner CSVs written to:\n\t' + os.getcwd() + '/' + file_name
+        path = self._output_path(output_location)
+        with self.stats.timer('write', rows=len(self.master_df)), self._open_writer(path) as writer:
+            writer.write(self.master_df)
+        self._print_output_path(path)
+
+    def _open_writer(self, path):
+        """
+        Return a writer for the combined output in self.output_format,
+            partitioned into a directory at path by self.partition_by if set
+        """
+        args = (path, self.schema_cols, self._types(), self.compression, self.row_group_size)
+        if self.partition_by:
+            return PartitionedWriter(*args, self.partition_by, self.output_format)
+        return OUTPUT_FORMATS[self.output_format](*args)
+
+    def _types(self):
+        """ return schema declared type of each column, by column name """
+        return {c.name:c.type for c in self.plan.columns}
+
+    def _output_path(self, output_location):
+        """
+        Return path of the combined output. A directory output location gets
+            the dated default file name, otherwise it is used as the path.
+            Partitioned output is a directory, without a file extension, and
+            an existing one (with a manifest) is rewritten in place of
+            being used as the directory to write a new one to.
+        """
+        if os.path.exists(os.path.join(output_location, PartitionedWriter.MANIFEST)):
+            if not self.partition_by:
+                raise ValueError(f'Output location {output_location} is partitioned output, '
+                                 'write to it with partition_by')
+            return output_location
+        if os.path.isdir(output_location):
+            date = datetime.today().strftime('%d%m%Y')
+            file_name = f'AggIns_combined_csvs_{date}'
+            if self.partition_by:
+                return os.path.join(output_location, file_name)
+            file_name += f'.{self.output_format}'
+            if self.output_format == 'csv' and self.compression:
+                file_name += '.' + COMPRESSION_EXTENSIONS[self.compression]
+            return os.path.join(output_location, file_name)
+        return output_location
+
+    def _print_output_path(self, path):
+        output_string = '\nCombined Aggregate Insurance Partner CSVs written to:\n\t' + os.path.abspath(path)
         print(output_string)
 
     def _just_str(self, my_str, val):
@@ -179,27 +696,129 @@ class Combine:
         """ print stats about errors in all CSVs """
         length = 100
         line = '='*length
-        name = 'Aggregator Insurance Inc. 🦓 CSV Error Report'.center(length, ' ')
+        title = 'Aggregator Insurance Inc. 🦓 CSV Error Report'
+        if self.sample_only:
+            title += ' (Sample Only)'
+        name = title.center(length, ' ')
         divider = '\n'.join(['\n', line, name, line])
         print(divider)
         print(self._just_str('Total Rows with Errors', self.total_rows_w_errors))
         print(self._just_str('Total Combined CSVs', self.total_csvs))
-        print(self._just_str('Total Rows in Combined CSV', len(self.master_df)))
+        if self.cache:
+            print(self._just_str('Total CSVs Loaded from Cache', self.total_csvs_cached))
+        print(self._just_str('Total Rows in Combined CSV', self.total_rows))
         print(self._just_str('Total CSVs with Errors', self.total_csvs_w_errors))
+        print(self._just_str('Total CSVs Quarantined', len(self.quarantined_csvs)))
+        for csv, reason in self.quarantined_csvs.items():
+            print(f'\t{csv}: {reason}')
+        if self.error_output:
+            print(self._just_str('Errors Written to', os.path.abspath(self.error_output)))
         print(f'Total Distinct Columns with Errors : {len(self.distinct_cols_w_errors)}')
+        if self.memory_mb_before_compact is not None:
+            print(self._just_str('Memory Before Compact (MB)', f'{self.memory_mb_before_compact:.2f}'))
+        print(self._just_str('Combined CSV Memory (MB)', f'{df_memory_mb(self.master_df):.2f}'))
+        # caches of worker processes are not included
+        for name, info in value_cache_info().items():
+            print(self._just_str(f'{name} Cache Hits / Misses', f'{info.hits} / {info.misses}'))
+        # stage times are summed over csvs, see Stats
+        for stage, m in self.stats.to_dict()['stages'].items():
+            rate = f' ({m["rows_per_sec"]:,.0f} rows/sec)' if m['rows_per_sec'] else ''
+            print(self._just_str(f'Time in {stage} (s)', f'{m["seconds"]:.3f}{rate}'))
         print(line)
             
 def main():
     parser = argparse.ArgumentParser(description='Combine and clean CSV input files from partners', add_help=True)
-    parser.add_argument('--csvs_path', type=str, required=True, help='location on system of csv files')
+    parser.add_argument('--csvs_path', type=str, default=None, help='location on system of csv files, or a glob of locations, required unless reingesting')
     parser.add_argument('--insurance_type', type=str, default='general', help='only general is available currently')
+    parser.add_argument('--vectorized', action='store_true', help='validate whole columns at once instead of cell by cell')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes used to validate csvs in parallel')
+    parser.add_argument('--pattern', type=str, default=None, help='glob of file names to combine, *.csv and compressed *.csv.gz, .bz2, .xz, .zst or .zip by default')
+    parser.add_argument('--recursive', action='store_true', help='combine csvs in subdirectories of csvs_path too')
+    parser.add_argument('--partition_filter', type=str, action='append', default=[],
+                        help='only read key=value partition directories passing this filter, e.g. "date>=2024-01-01", can be repeated')
+    parser.add_argument('--prefetch', type=int, default=2, help='csvs read ahead on background threads while one validates, 0 to turn off')
+    parser.add_argument('--chunksize', type=int, default=None, help='stream each csv this many rows at a time, which only bounds memory without --workers, and with --stream')
+    parser.add_argument('--stream', action='store_true', help='write each validated csv or chunk to the output as it is cleaned')
+    parser.add_argument('--output_location', type=str, default='.', help='output directory or file path, current directory by default')
+    parser.add_argument('--cache_dir', type=str, default=None, help='reuse validation of csvs unchanged since the last run cached here')
+    parser.add_argument('--value_cache_size', type=int, default=None, help='max values memoized per check, e.g. redirect link domains')
+    parser.add_argument('--dedup', action='store_true', help='validate each distinct value of a column once')
+    parser.add_argument('--output_format', type=str, default='csv', choices=sorted(OUTPUT_FORMATS), help='file format of the combined output')
+    parser.add_argument('--compression', type=str, default=None, help='compression codec of the combined output: gzip, bz2, xz or zstd for csv, snappy, gzip or zstd for parquet, lz4 or zstd for feather')
+    parser.add_argument('--compact', action='store_true', help='convert combined data to schema types, low cardinality strings to categoricals')
+    parser.add_argument('--string_dtype', type=str, default=None, choices=['python', 'pyarrow'], help='with --compact, store other strings as this pandas string dtype')
+    parser.add_argument('--partition_by', type=str, default=None, help='write one file per value of this schema column, e.g. "Provider Name", with a manifest')
+    parser.add_argument('--row_group_size', type=int, default=None, help='max rows per parquet row group or feather record batch')
+    parser.add_argument('--error_output', type=str, default=None, help='write every error to this .jsonl or .parquet file')
+    parser.add_argument('--no_print_errors', action='store_true', help='do not print rows with errors to the console')
+    parser.add_argument('--error_sample', type=int, default=None, help='print at most this many rows with errors per csv')
+    parser.add_argument('--max_printed_errors', type=int, default=None, help='stop printing rows with errors after this many')
+    parser.add_argument('--max_error_rate', type=float, default=None, help='quarantine csvs with more than this fraction of rows with errors')
+    parser.add_argument('--max_errors', type=int, default=None, help='quarantine csvs with more than this many rows with errors')
+    parser.add_argument('--sample_rows', type=int, default=1000, help='rows sampled to check the error budget before validating a whole csv')
+    parser.add_argument('--sample_only', action='store_true', help='validate only a sample of each csv, without writing combined output')
+    parser.add_argument('--quarantine_output', type=str, default=None, help='write rows with errors, annotated with their errors, to this .csv or .parquet file')
+    parser.add_argument('--reingest', type=str, default=None, help='validate a corrected quarantine output again and add its rows to the combined output file at --output_location')
+    parser.add_argument('--metrics', type=str, default=None, help='write time and rows of each stage, csv and validation rule to this json file')
+    parser.add_argument('--profile', type=str, default=None, help='write a cProfile dump of the run to this file, worker processes are not profiled')
     args = parser.parse_args()
+    if not args.csvs_path and not args.reingest:
+        parser.error('the following arguments are required: --csvs_path')
+    if args.reingest and not args.partition_by and os.path.isdir(args.output_location):
+        parser.error('--output_location must be the combined output file to reingest into')
+    if args.chunksize and args.workers > 1:
+        print('Note: with --workers each csv is validated whole in a worker process, '
+              '--chunksize does not bound memory unless --workers is 1')
     itype = args.insurance_type
 
-    c = Combine(itype, args.csvs_path)
-    c.combine_csvs()
-    c.write_combined_csv()
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    c = Combine(
+        itype, args.csvs_path,
+        vectorized=args.vectorized,
+        workers=args.workers,
+        chunksize=args.chunksize,
+        cache_dir=args.cache_dir,
+        value_cache_size=args.value_cache_size,
+        dedup=args.dedup,
+        output_format=args.output_format,
+        compression=args.compression,
+        row_group_size=args.row_group_size,
+        compact=args.compact,
+        string_dtype=args.string_dtype,
+        error_output=args.error_output,
+        print_errors=not args.no_print_errors,
+        error_sample=args.error_sample,
+        max_printed_errors=args.max_printed_errors,
+        max_error_rate=args.max_error_rate,
+        max_errors=args.max_errors,
+        sample_rows=args.sample_rows,
+        sample_only=args.sample_only,
+        quarantine_output=args.quarantine_output,
+        pattern=args.pattern,
+        prefetch=args.prefetch,
+        recursive=args.recursive,
+        partition_filters=args.partition_filter,
+        partition_by=args.partition_by,
+    )
+    if args.reingest:
+        c.reingest_quarantine(args.reingest, args.output_location)
+    elif args.sample_only:
+        c.combine_csvs()
+    elif args.stream:
+        c.stream_combined_csv(args.output_location)
+    else:
+        c.combine_csvs()
+        c.write_combined_csv(args.output_location)
     c.print_summary()
 
+    if args.profile:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+    if args.metrics:
+        c.stats.write_json(args.metrics)
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
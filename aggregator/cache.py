@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import pickle
+
+import pandas as pd
+
+# bump when the layout of cached entries changes
+CACHE_VERSION = 2
+
+
+class ManifestCache:
+    """
+    Cache of validated csvs for incremental Combine runs.
+
+    A manifest (manifest.json) records the path, size, mtime, content hash,
+        and schema version of every validated csv, next to a pickle of its
+        validated dataframes and error summary. A csv is validated again
+        only when its content or the schema definition changes.
+    """
+
+    def __init__(self, cache_dir, schema_version):
+        self.cache_dir = cache_dir
+        # cached pickles are only valid for the schema, cache layout and
+        # pandas version that wrote them
+        self.schema_version = f'{schema_version}-{CACHE_VERSION}-{pd.__version__}'
+        self.manifest_path = os.path.join(cache_dir, 'manifest.json')
+        os.makedirs(cache_dir, exist_ok=True)
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def _save(self):
+        """ write the manifest, replacing the previous one atomically """
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _file_hash(self, path):
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    def _cache_file(self, path):
+        return os.path.join(self.cache_dir, hashlib.sha256(path.encode()).hexdigest() + '.pkl')
+
+    def is_cached(self, csv):
+        """
+        Return True if csv has a cached validation for the current schema.
+        The csv is only hashed when its size or mtime changed since then.
+        """
+        path = os.path.abspath(csv)
+        entry = self.manifest.get(path)
+        if (entry is None
+            or entry['schema_version'] != self.schema_version
+            or not os.path.exists(self._cache_file(path))):
+            return False
+
+        st = os.stat(path)
+        if (st.st_size, st.st_mtime_ns) == (entry['size'], entry['mtime']):
+            return True
+        if st.st_size == entry['size'] and self._file_hash(path) == entry['sha256']:
+            # touched but unchanged
+            entry['mtime'] = st.st_mtime_ns
+            self._save()
+            return True
+        return False
+
+    def load(self, a):
+        """
+        Yield cached validated dataframes for AggCSV a, then restore
+            its error summary
+        """
+        with open(self._cache_file(os.path.abspath(a.csv_path)), 'rb') as f:
+            while True:
+                item = pickle.load(f)
+                if not isinstance(item, pd.DataFrame):
+                    break
+                yield item
+        for k, v in item.items():
+            setattr(a, k, v)
+
+    def record(self, a, chunks):
+        """
+        Pass through validated dataframes for AggCSV a while caching them,
+            then cache its error summary and add it to the manifest
+        """
+        path = os.path.abspath(a.csv_path)
+        st = os.stat(path)
+        entry = {
+            'path':path,
+            'size':st.st_size,
+            'mtime':st.st_mtime_ns,
+            'sha256':self._file_hash(path),
+            'schema_version':self.schema_version,
+        }
+
+        cache_file = self._cache_file(path)
+        tmp_path = cache_file + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                for df in chunks:
+                    pickle.dump(df, f, pickle.HIGHEST_PROTOCOL)
+                    yield df
+                summary = {
+                    'rows_w_errors':a.rows_w_errors,
+                    'distinct_cols_w_errors':a.distinct_cols_w_errors,
+                    'errors':a.errors,
+                    'err_df':a.err_df,
+                    'quarantine_reason':a.quarantine_reason,
+                }
+                pickle.dump(summary, f, pickle.HIGHEST_PROTOCOL)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, cache_file)
+        self.manifest[path] = entry
+        self._save()
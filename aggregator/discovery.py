@@ -0,0 +1,114 @@
+import fnmatch
+import glob
+import operator
+import os
+import re
+from collections import namedtuple
+from urllib.parse import unquote
+
+from aggregator.utilities import COMPRESSION_EXTENSIONS
+
+# file names combined by default, plain csvs or csvs compressed with a
+# supported codec, so backups like a.csv.bak are not combined twice
+CSV_PATTERNS = ('*.csv',) + tuple(f'*.csv.{e}' for e in COMPRESSION_EXTENSIONS.values())
+
+OPERATORS = {
+    '=':operator.eq,
+    '==':operator.eq,
+    '!=':operator.ne,
+    '>=':operator.ge,
+    '<=':operator.le,
+    '>':operator.gt,
+    '<':operator.lt,
+}
+_FILTER_RE = re.compile(r'^\s*([^=!<>]+?)\s*(==|!=|>=|<=|=|>|<)\s*(.*?)\s*$')
+
+
+class PartitionFilter(namedtuple('PartitionFilter', ['key', 'op', 'value'])):
+    """
+    Condition on a partition directory, named key=value, of input paths,
+        e.g. date>=2024-01-01 or partner=acme. Values are compared as
+        strings, which orders iso dates correctly. Keys and values may be
+        percent-encoded, as PartitionedWriter writes them.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, text):
+        """ return a PartitionFilter from text like 'date>=2024-01-01' """
+        m = _FILTER_RE.match(text)
+        if m is None:
+            raise ValueError(f'Partition filter {text!r} is not of the form key<op>value, '
+                             f'with op one of {" ".join(OPERATORS)}')
+        return cls(*map(unquote, m.groups()))
+
+    def matches(self, partitions):
+        """
+        Return whether partitions, {key:value}, pass the filter.
+        Paths without the key's partition are not filtered.
+        """
+        if self.key not in partitions:
+            return True
+        return OPERATORS[self.op](partitions[self.key], self.value)
+
+
+def path_partitions(path):
+    """ return {key:value} of the key=value components of path """
+    partitions = {}
+    for part in os.path.normpath(path).split(os.sep):
+        _add_partition(partitions, part)
+    return partitions
+
+def _add_partition(partitions, name):
+    """ add the key and value of a directory name like key=value to partitions, decoded """
+    key, eq, value = name.partition('=')
+    if eq and key:
+        partitions[unquote(key)] = unquote(value)
+
+def _matches(name, patterns):
+    """ return whether a file name matches any of patterns, ignoring case """
+    name = name.lower()
+    return not name.startswith('.') and any(fnmatch.fnmatch(name, p.lower()) for p in patterns)
+
+def discover_csvs(csvs_path, patterns=CSV_PATTERNS, recursive=False, filters=()):
+    """
+    Return sorted paths of input csvs under csvs_path, which may be a glob
+        of directories or files. Only file names matching patterns are
+        kept, and hidden files are skipped.
+    recursive descends into subdirectories. Directories named key=value
+        are pruned by filters, PartitionFilters, before they are listed.
+    Raise FileNotFoundError if csvs_path does not exist or the glob
+        matches nothing, so a mistyped path never gives an empty output.
+    """
+    if glob.has_magic(csvs_path):
+        roots = sorted(glob.glob(csvs_path))
+        if not roots:
+            raise FileNotFoundError(f'No files or directories match {csvs_path}')
+    elif os.path.exists(csvs_path):
+        roots = [csvs_path]
+    else:
+        raise FileNotFoundError(f'csvs_path {csvs_path} does not exist')
+    csvs = []
+    for root in roots:
+        partitions = path_partitions(root)
+        if not all(f.matches(partitions) for f in filters):
+            continue
+        if os.path.isdir(root):
+            _walk(root, partitions, patterns, recursive, filters, csvs)
+        elif _matches(os.path.basename(root), patterns):
+            csvs.append(root)
+    return sorted(csvs)
+
+def _walk(directory, partitions, patterns, recursive, filters, csvs):
+    """ add csvs in directory to csvs, and those in its subdirectories if recursive """
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if not recursive or entry.name.startswith('.'):
+                    continue
+                sub = dict(partitions)
+                _add_partition(sub, entry.name)
+                if all(f.matches(sub) for f in filters):
+                    _walk(directory + '/' + entry.name, sub, patterns, recursive, filters, csvs)
+            elif entry.is_file() and _matches(entry.name, patterns):
+                csvs.append(directory + '/' + entry.name)
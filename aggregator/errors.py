@@ -0,0 +1,183 @@
+import json
+import os
+from array import array
+
+import numpy as np
+import pandas as pd
+
+
+class ErrorLog:
+    """
+    Compact columnar store of validation errors.
+
+    Errors are held as parallel arrays of row index labels, failed values,
+        and integer codes for csv path, column, and validation rule,
+        instead of a snapshot DataFrame per error. Offending rows are
+        looked up from the source DataFrame only when a report is made.
+    """
+    __slots__ = ('rows', 'values', 'csv_codes', 'col_codes', 'rule_codes',
+                 'csv_paths', 'col_names', 'rule_names')
+
+    def __init__(self):
+        self.rows = []
+        self.values = []
+        self.csv_codes = array('i')
+        self.col_codes = array('i')
+        self.rule_codes = array('i')
+        self.csv_paths = []
+        self.col_names = []
+        self.rule_names = []
+
+    def _code(self, names, name):
+        """ return integer code for name, adding it to names if new """
+        if name not in names:
+            names.append(name)
+        return names.index(name)
+
+    def _decode(self, names, codes):
+        """ return an object array of names for an array of codes """
+        return np.asarray(names, dtype=object)[np.asarray(codes, dtype=int)]
+
+    def extend(self, csv_path, col_name, rule, rows, values):
+        """ add a block of errors for a single column and rule """
+        rows = list(rows)
+        n = len(rows)
+        self.rows.extend(rows)
+        self.values.extend(values)
+        self.csv_codes.extend([self._code(self.csv_paths, csv_path)]*n)
+        self.col_codes.extend([self._code(self.col_names, col_name)]*n)
+        self.rule_codes.extend([self._code(self.rule_names, rule)]*n)
+
+    def update(self, other):
+        """ add all errors from another ErrorLog, keeping their order """
+        for names, codes, other_names, other_codes in [
+                (self.csv_paths, self.csv_codes, other.csv_paths, other.csv_codes),
+                (self.col_names, self.col_codes, other.col_names, other.col_codes),
+                (self.rule_names, self.rule_codes, other.rule_names, other.rule_codes)]:
+            recode = [self._code(names, name) for name in other_names]
+            codes.extend([recode[c] for c in other_codes])
+        self.rows.extend(other.rows)
+        self.values.extend(other.values)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        """ yield errors as [csv_path, column, row, rule, value] """
+        for i in range(len(self.rows)):
+            yield [self.csv_paths[self.csv_codes[i]],
+                   self.col_names[self.col_codes[i]],
+                   self.rows[i],
+                   self.rule_names[self.rule_codes[i]],
+                   self.values[i]]
+
+    def to_frame(self):
+        """ return errors as a DataFrame, one error per row """
+        return pd.DataFrame({
+            'csv_path':self._decode(self.csv_paths, self.csv_codes),
+            'column':self._decode(self.col_names, self.col_codes),
+            'row':pd.Series(self.rows, dtype=object),
+            'rule':self._decode(self.rule_names, self.rule_codes),
+            'value':pd.Series(self.values, dtype=object),
+        })
+
+
+class ErrorSink:
+    """
+    Base class for structured error outputs, one record per error with
+        csv_path, column, row, rule and the value that failed.
+
+    Errors are appended one ErrorLog at a time as each csv is validated.
+        Like the combined output, they are written to a temporary file
+        that is renamed to path on close.
+    """
+    extension = None
+
+    def __init__(self, path):
+        self.path = path
+        self.errors = 0
+        out_dir, name = os.path.split(os.path.abspath(path))
+        self.tmp_path = os.path.join(out_dir, f'.{name}.{os.getpid()}.tmp')
+        self._open()
+
+    def write(self, errors):
+        """ append the errors of an ErrorLog """
+        if len(errors):
+            self._write(errors.to_frame())
+            self.errors += len(errors)
+
+    def close(self):
+        self._close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self._close()
+        os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class JSONLErrorSink(ErrorSink):
+    """ write errors as JSON Lines, one json object per error """
+    extension = 'jsonl'
+
+    def _open(self):
+        self.f = open(self.tmp_path, 'w', encoding='utf-8')
+
+    def _write(self, df):
+        for record in df.to_dict('records'):
+            value = record['value']
+            # NaN is not valid json, and numpy values are not serializable
+            record['value'] = None if pd.isna(value) else getattr(value, 'item', lambda: value)()
+            record['row'] = int(record['row'])
+            self.f.write(json.dumps(record, default=str) + '\n')
+
+    def _close(self):
+        self.f.close()
+
+
+class ParquetErrorSink(ErrorSink):
+    """
+    Write errors as a parquet table, failed values as strings.
+    Requires pyarrow.
+    """
+    extension = 'parquet'
+
+    def _open(self):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('pyarrow is required for parquet error output, '
+                              'install it with: pip install aggregator[columnar]') from None
+        self.pa = pa
+        self.schema = pa.schema([('csv_path', pa.string()), ('column', pa.string()),
+                                 ('row', pa.int64()), ('rule', pa.string()),
+                                 ('value', pa.string())])
+        self.writer = pq.ParquetWriter(self.tmp_path, self.schema)
+
+    def _write(self, df):
+        df['row'] = df['row'].astype('int64')
+        df['value'] = df['value'].map(lambda v: None if pd.isna(v) else str(v))
+        self.writer.write_table(self.pa.Table.from_pandas(df, schema=self.schema, preserve_index=False))
+
+    def _close(self):
+        self.writer.close()
+
+
+ERROR_SINKS = {s.extension:s for s in [JSONLErrorSink, ParquetErrorSink]}
+
+def open_error_sink(path):
+    """ return an ErrorSink for path, chosen by its file extension """
+    ext = os.path.splitext(path)[1].lstrip('.')
+    if ext not in ERROR_SINKS:
+        raise ValueError(f'Error output {path} must end in one of: '
+                         + ', '.join('.' + e for e in sorted(ERROR_SINKS)))
+    return ERROR_SINKS[ext](path)
@@ -1,61 +1,183 @@
+import re
+import hashlib
 import inspect
 import string
 import functools
+from time import perf_counter
+from collections import namedtuple
+from types import MappingProxyType
 
-import validators
 import numpy as np
+import pandas as pd
+
+from aggregator.errors import ErrorLog
+from aggregator.stats import Stats
 
 class SchemaTypeNotDeclared(ValueError):
     """ raise this when a type is not declared for a schema class """
 
+# ---------------------------------------------------
+# memoized per-value checks
+# ---------------------------------------------------
+def _valid_domain(domain):
+    """ regex based domain check from validators """
+    # imported on first use to keep it out of CLI startup
+    import validators
+    return bool(validators.domain(domain))
+
+def _format_phone_number(x):
+    """ return phone number x as (xxx)xxx-xxxx or xxx-xxxx, False if invalid """
+    x = ''.join([i for i in x if i in string.digits])
+    if len(x) == 7:
+        return f'{x[:3]}-{x[3:]}'
+    elif len(x) == 10:
+        return f'({x[:3]}){x[3:6]}-{x[6:]}'
+    return False
+
+def _format_zipcode(x):
+    """ return zipcode x as xxxxx-xxxx or xxxxx, False if invalid """
+    x = ''.join([i for i in x if i in string.digits])
+    if len(x) == 9:
+        return f'{x[:5]}-{x[5:]}'
+    elif len(x) == 5:
+        return x
+    return False
+
+# partner files repeat the same handful of values thousands of times,
+# so these pure checks are memoized in LRU caches shared by every schema
+# object (and so every csv of a Combine run) in a process
+VALUE_CHECKS = {
+    'domain':_valid_domain,
+    'phone_number':_format_phone_number,
+    'zipcode':_format_zipcode,
+}
+value_caches = {}
+
+def configure_value_caches(maxsize=2**16):
+    """
+    (Re)create the LRU caches for per-value checks holding at most
+        maxsize values each. Clears cached values and hit/miss counters.
+    """
+    for name, check in VALUE_CHECKS.items():
+        value_caches[name] = functools.lru_cache(maxsize=maxsize)(check)
+
+def value_cache_info():
+    """ return lru_cache hits, misses, maxsize and size for each check """
+    return {name:cache.cache_info() for name, cache in value_caches.items()}
+
+configure_value_caches()
+
+# ---------------------------------------------------
+# compiled schema plans
+# ---------------------------------------------------
+ValidationStep = namedtuple('ValidationStep', ['rule', 'validation', 'vec'])
+ColumnPlan = namedtuple('ColumnPlan', ['attr', 'name', 'type', 'nullable', 'col', 'steps'])
+SchemaPlan = namedtuple('SchemaPlan', ['schema', 'columns', 'by_name', 'version'])
+
+@functools.lru_cache(maxsize=None)
+def compile_schema(schema_cls):
+    """
+    Compile a schema class into an immutable SchemaPlan, once per class.
+    Columns are ordered by attribute name, and each holds its resolved
+        type and nullability, a read-only copy of its attribute map, and
+        the ordered standard and column validations to run on it (with
+        their vec_ versions, if defined).
+    """
+    columns = []
+    for attr, d in inspect.getmembers(schema_cls):
+        if (type(d) != dict
+            or '__' in attr):
+            continue
+        validations = ([getattr(schema_cls, n) for n in schema_cls.STD_VALIDATIONS]
+                       + list(d.get('validations', [])))
+        steps = tuple(ValidationStep(v.__name__, v, getattr(schema_cls, 'vec_' + v.__name__, None))
+                      for v in validations)
+        col = MappingProxyType(dict(d, validations=tuple(d.get('validations', []))))
+        columns.append(ColumnPlan(attr, d.get('name'), d.get('type'), d.get('nullable'), col, steps))
+
+    by_name = MappingProxyType({c.name:c for c in columns})
+    return SchemaPlan(schema_cls, tuple(columns), by_name, _schema_version(schema_cls, columns))
+
+def _schema_version(schema_cls, columns):
+    """
+    Return a hash of the schema definition: column attributes and the
+        source of the schema class, the Validation classes it inherits,
+        and the memoized per-value checks in VALUE_CHECKS they call.
+        Changes whenever columns or validations change.
+    """
+    h = hashlib.sha256()
+    for c in columns:
+        col_type = getattr(c.type, '__name__', None)
+        validations = [v.__qualname__ for v in c.col['validations']]
+        h.update(repr((c.attr, c.name, col_type, c.nullable, validations)).encode())
+    sources = list(schema_cls.__mro__[:-1]) + [VALUE_CHECKS[k] for k in sorted(VALUE_CHECKS)]
+    for obj in sources:
+        try:
+            h.update(inspect.getsource(obj).encode())
+        except (OSError, TypeError):
+            pass
+    return h.hexdigest()
+
 class Validation:
     """
     All insurance classes inherit this class of methods
         for validating data from partners and tracking errors.
     """
+    # standard validations, applied to every column before its own
+    STD_VALIDATIONS = ('validate_type', 'validate_null')
+
     def __init__(self):
-        self.row = 0
         self.rows_w_errors = set()
         self.distinct_cols_w_errors = set()
-        self.errors = []
-        self.std_validations = [self.validate_type, self.validate_null]
+        self.errors = ErrorLog()
+        self.stats = Stats()
 
     def _error_count(func):
         """
-        Provided to decorate Validation methods to allow
-            tracking of errors as data is being validated/cleaned
+        Provided to decorate Validation methods written to work on a
+            single input value. Errors are reported by row index label,
+            so a value may be validated in any order, chunk or process.
+        Columns are validated through validate_series, which reports each
+            validation's failures as one block. Single values are tracked
+            when their row label is passed as row.
         """
         @functools.wraps(func)
-        def error_tracker(self, *args):
-            x = args[0]
-            col = args[1]
-            csv_path = args[2]
-            df_row = args[3]
+        def error_tracker(self, x, col, csv_path=None, *_, row=None):
             result = func(self, x, col)
-            
-            if not result:
-                df_row = df_row.loc[self.row].to_frame().T
-                self.rows_w_errors.add(self.row)
-                self.distinct_cols_w_errors.add(col['name'])
-                self.errors.append([csv_path, col['name'], self.row, func.__name__, x, df_row])
 
-            self.row += 1
+            if row is not None and not result:
+                self.report_errors(csv_path, col['name'], func.__name__, [row], [x])
+
             return result
 
         return error_tracker
 
+    def get_plan(self):
+        """ return the compiled SchemaPlan of this schema class """
+        return compile_schema(type(self))
+
     def get_schema_attrs(self):
         """
         Return defined schema class attributes and values as map
         """
-        for n, d in inspect.getmembers(self):
-            if (type(d) == dict
-                and '__' not in n):
-                yield n, d
-
-    def set_row(self, val):
-        self.row = val
-    
+        for c in self.get_plan().columns:
+            yield c.attr, c.col
+
+    def schema_version(self):
+        """ return a hash of the schema definition, see _schema_version """
+        return self.get_plan().version
+
+    def report_errors(self, csv_path, col_name, rule, rows, values):
+        """
+        Record a block of failures for a single validation rule.
+        rows are DataFrame index labels, matched up with the failed values.
+        """
+        if len(rows) == 0:
+            return
+        self.rows_w_errors.update(rows)
+        self.distinct_cols_w_errors.add(col_name)
+        self.errors.extend(csv_path, col_name, rule, rows, values)
+
     def get_rows_w_errors(self):
         return self.rows_w_errors
 
@@ -65,8 +187,148 @@ class Validation:
     def get_errors(self):
         return self.errors
 
-    def get_std_validations(self):
-        return self.std_validations
+    def get_stats(self):
+        return self.stats
+
+    def get_vectorized(self, validation):
+        """
+        Return the whole-column version of a validation method
+            (named vec_<validation>), or None if only a per-cell
+            version is defined
+        """
+        return getattr(self, 'vec_' + validation.__name__, None)
+
+    # ---------------------------------------------------
+    # vectorized column validation
+    # ---------------------------------------------------
+    @staticmethod
+    def _error_mask(cleaned):
+        """
+        Whole-column equivalent of the `not result` check in _error_count
+            (False, 0, 0.0 and empty strings are errors, NaN is not)
+        """
+        return (cleaned == False) | (cleaned == '')
+
+    def _cell_apply(self, validation, s, col):
+        """ fall back to running a per-cell validation over a column """
+        func = validation.__wrapped__
+        cleaned = s.apply(lambda x: func(self, x, col))
+        return cleaned, self._error_mask(cleaned)
+
+    def validate_series(self, s, col, csv_path, vectorized=False, dedup=False):
+        """
+        Apply standard and column validations to a Series, which may be
+            a whole column or any chunk of one.
+        vectorized=True uses each validation's vec_ version where defined,
+            otherwise validations are applied cell by cell.
+        dedup=True validates each distinct value once and maps the cleaned
+            values and errors back to every row holding it.
+        Failures of each validation are reported as one block keyed by
+            the Series index.
+        """
+        if not dedup:
+            def report(rule, values, mask):
+                self.report_errors(csv_path, col['name'], rule, values.index[mask], values[mask])
+            return self._run_validations(s, col, vectorized, report).infer_objects()
+
+        codes, uniques = pd.factorize(s)
+        uniques = pd.Series(uniques, dtype=object)
+        # factorize codes missing values as -1, give them a value of their own
+        if (codes == -1).any():
+            codes[codes == -1] = len(uniques)
+            uniques = pd.Series(list(uniques) + [np.nan], dtype=object)
+
+        def report(rule, values, mask):
+            row_mask = mask.values[codes]
+            self.report_errors(csv_path, col['name'], rule, s.index[row_mask],
+                               values.values[codes[row_mask]])
+        cleaned = self._run_validations(uniques, col, vectorized, report)
+        return pd.Series(cleaned.values[codes], index=s.index).infer_objects()
+
+    def _run_validations(self, s, col, vectorized, report):
+        """
+        Run each validation for col over s in order, passing the values
+            it was given and its error mask to report. Return cleaned s.
+        The time each validation takes is added to self.stats.
+        """
+        s = s.astype(object)
+        for step in self.get_plan().by_name[col['name']].steps:
+            start = perf_counter()
+            if vectorized and step.vec:
+                cleaned, mask = step.vec(self, s, col)
+            else:
+                cleaned, mask = self._cell_apply(step.validation, s, col)
+            self.stats.add_rule(col['name'], step.rule, perf_counter() - start, len(s))
+            report(step.rule, s, mask)
+            s = cleaned
+        return s
+
+    def vec_validate_type(self, s, col):
+        """ whole-column version of validate_type """
+        if not col.get('type'):
+            err_msg = 'No type declared for {}'.format(col['name'])
+            raise SchemaTypeNotDeclared(err_msg)
+        if col['type'] not in (str, float):
+            return self._cell_apply(Validation.validate_type, s, col)
+
+        x = s.astype(str)
+        if col['type'] == float:
+            x = x.str.replace(r'[^0-9.]', '', regex=True)
+            valid = x.str.fullmatch(r'\d+\.?\d*|\.\d+')
+            cleaned = pd.Series(False, index=s.index, dtype=object)
+            cleaned[valid] = x[valid].astype(float)
+            x = cleaned
+        return x, self._error_mask(x)
+
+    def vec_validate_null(self, s, col):
+        """ whole-column version of validate_null """
+        y = s.astype(str).str.lower().str.replace('/', '', regex=False)
+        null_vals = ['null', 'na', '0', 'nan']
+        ws_only = '[' + re.escape(string.whitespace) + ']*'
+        null_datum = y.str.fullmatch(ws_only) | y.isin(null_vals)
+
+        fill = np.nan if col['nullable'] else False
+        cleaned = s.astype(object).mask(null_datum, fill)
+        return cleaned, self._error_mask(cleaned)
+
+    def vec_upper_campaign_id(self, s, col):
+        """ whole-column version of upper_campaign_id """
+        cleaned = s.astype(str).str.upper()
+        return cleaned, self._error_mask(cleaned)
+
+    def vec_valid_cost_per_ad_click(self, s, col):
+        """ whole-column version of valid_cost_per_ad_click """
+        x = s.astype(float)
+        cleaned = x.astype(object).mask(x == 0, False)
+        return cleaned, self._error_mask(cleaned)
+
+    def vec_valid_redirect_link(self, s, col):
+        """ whole-column version of valid_redirect_link """
+        x = s.astype(str)
+        valid = x.str.split('/', n=1).str[0].map(value_caches['domain']).astype(bool)
+        cleaned = x.astype(object).where(valid, False)
+        return cleaned, self._error_mask(cleaned)
+
+    def vec_valid_phone_number(self, s, col):
+        """ whole-column version of valid_phone_number """
+        x = s.astype(str).str.replace(r'[^0-9]', '', regex=True)
+        seven = x.str.len() == 7
+        ten = x.str.len() == 10
+        cleaned = pd.Series(False, index=s.index, dtype=object)
+        cleaned[seven] = x[seven].str[:3] + '-' + x[seven].str[3:]
+        cleaned[ten] = ('(' + x[ten].str[:3] + ')' + x[ten].str[3:6]
+                        + '-' + x[ten].str[6:])
+        return cleaned, self._error_mask(cleaned)
+
+    def vec_valid_zipcode(self, s, col):
+        """ whole-column version of valid_zipcode """
+        x = s.astype(str).str.replace(r'[^0-9]', '', regex=True)
+        five = x.str.len() == 5
+        nine = x.str.len() == 9
+        cleaned = pd.Series(False, index=s.index, dtype=object)
+        cleaned[five] = x[five]
+        cleaned[nine] = x[nine].str[:5] + '-' + x[nine].str[5:]
+        return cleaned, self._error_mask(cleaned)
 
     # ---------------------------------------------------
     # standard column validation
@@ -148,10 +410,12 @@ class Validation:
     @_error_count
     def valid_redirect_link(self, *args):
         """
+        Check the domain of a redirect link is valid.
+        Domain checks are memoized in value_caches['domain'].
         """
         x = str(args[0])
         my_domain = x.split('/',1)[0]
-        if validators.domain(my_domain):
+        if value_caches['domain'](my_domain):
             return x
         return False
 
@@ -162,22 +426,17 @@ class Validation:
             this is a working number.
         Standardize all valid phone numbers to be of form (xxx)xxx-xxxx
             or xxx-xxxx.
+        Memoized in value_caches['phone_number'].
         """
-        x = str(args[0])
-        x = ''.join([i for i in x if i in string.digits])
-        if len(x) == 7 or len(x) == 10:
-            if len(x) == 7:
-                x = f'{x[:3]}-{x[3:]}'
-            else:
-                x = f'({x[:3]}){x[3:6]}-{x[6:]}'
-            return x
-        else:
-            return False
+        return value_caches['phone_number'](str(args[0]))
 
     @_error_count
     def standardize_address(self, *args):
         """ standardize address, validating if its a legitimate
-        address not currently supported """
+        address not currently supported
+        No vec_ version: pandas has no column-wise string.capwords (str.title
+        differs on apostrophes and digits), and a regex with a callback per
+        word is slower than this per-cell version """
         x = args[0]
         return string.capwords(str(x))
 
@@ -187,15 +446,9 @@ class Validation:
         Only checks if zipcode is correct format.
         Does not check if zipcode is legitimate.
         Standardize zipcodes to xxxxx-xxxx and xxxxx
+        Memoized in value_caches['zipcode'].
         """
-        x = str(args[0])
-        x = ''.join([i for i in x if i in string.digits])
-        if len(x) == 5 or len(x) == 9:
-            if len(x) == 9:
-                x = f'{x[:5]}-{x[5:]}'
-            return x
-        else:
-            return False
+        return value_caches['zipcode'](str(args[0]))
 
 class GeneralSchema(Validation):
     """
@@ -0,0 +1,78 @@
+import json
+from contextlib import contextmanager
+from time import perf_counter
+
+
+class Stats:
+    """
+    Wall time and rows processed by each stage of a run.
+
+    Stages (e.g. read, validate, print_errors, write) are totalled for the
+        whole run and for each csv, and the time spent in each validation
+        rule is totalled by column. Stats of csvs validated in worker
+        processes are merged in with update, so stage seconds are summed
+        across files rather than elapsed.
+    """
+
+    def __init__(self):
+        # stage -> [seconds, rows]
+        self.stages = {}
+        # csv path -> stage -> [seconds, rows]
+        self.files = {}
+        # column name -> rule -> [seconds, values]
+        self.rules = {}
+
+    def add(self, stage, seconds=0.0, rows=0, csv=None):
+        """ add seconds and rows to a stage, and to the stage of csv if given """
+        _add(self.stages, stage, seconds, rows)
+        if csv is not None:
+            _add(self.files.setdefault(csv, {}), stage, seconds, rows)
+
+    @contextmanager
+    def timer(self, stage, csv=None, rows=0):
+        """ add the wall time of the with block, and rows, to a stage """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, perf_counter() - start, rows, csv)
+
+    def add_rule(self, column, rule, seconds, values):
+        """ add the time a validation rule took over values of column """
+        _add(self.rules.setdefault(column, {}), rule, seconds, values)
+
+    def update(self, other):
+        """ add the stats of another Stats object """
+        for stage, (seconds, rows) in other.stages.items():
+            _add(self.stages, stage, seconds, rows)
+        for csv, stages in other.files.items():
+            for stage, (seconds, rows) in stages.items():
+                _add(self.files.setdefault(csv, {}), stage, seconds, rows)
+        for column, rules in other.rules.items():
+            for rule, (seconds, values) in rules.items():
+                self.add_rule(column, rule, seconds, values)
+
+    def to_dict(self):
+        """ return stats as json serializable dicts with rows per second """
+        return {
+            'stages':{s:_metrics(*v) for s, v in self.stages.items()},
+            'files':{f:{s:_metrics(*v) for s, v in stages.items()}
+                     for f, stages in self.files.items()},
+            'rules':{c:{r:_metrics(*v, unit='values') for r, v in rules.items()}
+                     for c, rules in self.rules.items()},
+        }
+
+    def write_json(self, path):
+        """ write stats to a json metrics file """
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+
+def _add(totals, key, seconds, rows):
+    total = totals.setdefault(key, [0.0, 0])
+    total[0] += seconds
+    total[1] += rows
+
+def _metrics(seconds, rows, unit='rows'):
+    per_sec = rows / seconds if seconds and rows else None
+    return {'seconds':seconds, unit:rows, f'{unit}_per_sec':per_sec}
@@ -1,19 +1,183 @@
-from aggregator import schema
-from tests.conftest import TestSchema
+import bz2
+import gzip
+import importlib
+import lzma
+import re
+
+import pandas as pd
 
 class SchemaNotFoundError(ValueError):
     """ raise when string is provided with no corresponding schema object"""
 
-def schema_map(schema_type):
+# entry point group other packages can use to provide schema classes
+ENTRY_POINT_GROUP = 'aggregator.schemas'
+
+# schema name -> schema class, or 'module:ClassName' path imported on first use
+# so schemas (and their dependencies) are only loaded when asked for
+_schema_registry = {
+    'general':'aggregator.schema:GeneralSchema',
+}
+
+def register_schema(name, schema=None):
     """
-    Return schema object from map
+    Register a schema class, or a 'module:ClassName' path to import lazily,
+        under name for schema_map. Can be used as a class decorator:
+
+        @register_schema('auto')
+        class AutoSchema(Validation):
+            ...
     """
-    sm = {
-        'general':schema.GeneralSchema(),
-        'test': TestSchema()
-    }
-    if schema_type not in sm:
+    if schema is None:
+        def decorator(cls):
+            _schema_registry[name] = cls
+            return cls
+        return decorator
+    _schema_registry[name] = schema
+    return schema
+
+def _entry_point(name):
+    """ return 'module:ClassName' of schema name from installed entry points """
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        from importlib_metadata import entry_points
+    eps = entry_points()
+    group = eps.select(group=ENTRY_POINT_GROUP) if hasattr(eps, 'select') else eps.get(ENTRY_POINT_GROUP, [])
+    for ep in group:
+        if ep.name == name:
+            return ep.value
+    return None
+
+def _resolve_schema(schema_type):
+    """ return registered schema class, importing it on first use """
+    schema = _schema_registry.get(schema_type) or _entry_point(schema_type)
+    if schema is None:
         err_msg = f'Schema obj for string {schema_type} not found'
         raise SchemaNotFoundError(err_msg)
 
-    return sm[schema_type]
\ No newline at end of file
+    if isinstance(schema, str):
+        module, cls_name = schema.split(':')
+        schema = getattr(importlib.import_module(module), cls_name)
+        _schema_registry[schema_type] = schema
+    return schema
+
+def schema_map(schema_type):
+    """
+    Return a new schema object for schema_type
+    """
+    return _resolve_schema(schema_type)()
+
+def df_memory_mb(df):
+    """
+    Return memory used by a dataframe in megabytes,
+        including the contents of object columns
+    """
+    return df.memory_usage(deep=True).sum() / 2**20
+
+def require_pandas(version, feature):
+    """ raise a clear error if installed pandas is older than version, e.g. (1, 4) """
+    installed = tuple(int(v) for v in re.findall(r'\d+', pd.__version__)[:2])
+    if installed < version:
+        raise RuntimeError(f'{feature} requires pandas >= {".".join(map(str, version))}, '
+                           f'pandas {pd.__version__} is installed')
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('zstandard is required for zstd compression, '
+                          'install it with: pip install aggregator[zstd]') from None
+    return zstandard
+
+def normalize_header(name):
+    """
+    Return a column name reduced to lowercase letters and digits, so
+        header variations like 'Cost Per Ad Click', 'cost_per_ad_click'
+        and ' COST-PER-AD-CLICK' compare equal
+    """
+    return re.sub(r'[^a-z0-9]', '', str(name).lower())
+
+def match_columns(headers, columns):
+    """
+    Return {header:column} for each of columns found in headers by
+        normalized name. The first matching header is used when several
+        normalize to the same name.
+    """
+    wanted = {normalize_header(c):c for c in columns}
+    matched = {}
+    for h in headers:
+        c = wanted.pop(normalize_header(h), None)
+        if c is not None:
+            matched[h] = c
+    return matched
+
+def compact_dtypes(df, types, category_ratio=0.5, string_dtype=None):
+    """
+    Return df with memory compact dtypes for the schema declared types
+        of its columns, {column name: type}.
+    float and int columns become float64, str columns with at most
+        category_ratio distinct values per row become categoricals, and
+        other str columns are kept as objects or, with string_dtype set to
+        'pyarrow', converted to pandas' Arrow backed string dtype.
+    """
+    df = df.copy()
+    for c, t in types.items():
+        if c not in df.columns:
+            continue
+        if t in (float, int):
+            df[c] = pd.to_numeric(df[c]).astype('float64')
+        elif t == str:
+            if df[c].nunique() <= category_ratio * len(df):
+                df[c] = df[c].astype('category')
+            elif string_dtype:
+                if string_dtype == 'pyarrow':
+                    require_pandas((1, 3), 'Arrow backed strings')
+                df[c] = df[c].astype(pd.StringDtype(string_dtype))
+    return df
+
+# leading bytes of compressed files, and their pandas compression names
+COMPRESSION_MAGIC = {
+    b'\x1f\x8b':'gzip',
+    b'BZh':'bz2',
+    b'\x28\xb5\x2f\xfd':'zstd',
+    b'\xfd7zXZ\x00':'xz',
+    b'PK\x03\x04':'zip',
+}
+# file extensions of compressed outputs
+COMPRESSION_EXTENSIONS = {'gzip':'gz', 'bz2':'bz2', 'zstd':'zst', 'xz':'xz', 'zip':'zip'}
+
+def detect_compression(path):
+    """
+    Return pandas compression name of a file from its leading bytes, or
+        None if it is not compressed. Anything other than a file path is
+        left for pandas to infer.
+    """
+    if not isinstance(path, str):
+        return 'infer'
+    with open(path, 'rb') as f:
+        head = f.read(6)
+    for magic, compression in COMPRESSION_MAGIC.items():
+        if head.startswith(magic):
+            if compression == 'zstd':
+                require_pandas((1, 4), 'Reading zstd compressed csvs')
+                _import_zstandard()
+            return compression
+    return None
+
+def open_text(path, compression=None):
+    """
+    Open a text file for writing, compressed with gzip, bz2, xz or zstd
+        (which requires the zstandard package) when compression is given
+    """
+    kwargs = {'encoding':'utf-8', 'newline':''}
+    if compression is None:
+        return open(path, 'w', **kwargs)
+    elif compression == 'gzip':
+        return gzip.open(path, 'wt', **kwargs)
+    elif compression == 'bz2':
+        return bz2.open(path, 'wt', **kwargs)
+    elif compression == 'xz':
+        return lzma.open(path, 'wt', **kwargs)
+    elif compression == 'zstd':
+        return _import_zstandard().open(path, 'w', **kwargs)
+    raise ValueError(f'Compression {compression} not supported for csv output')
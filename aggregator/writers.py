@@ -0,0 +1,292 @@
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import pandas as pd
+
+from aggregator.utilities import open_text, detect_compression, COMPRESSION_EXTENSIONS
+
+
+class CombinedWriter:
+    """
+    Base class for writers of the combined output.
+
+    Dataframes are appended as they are validated, with columns always in
+        schema order. Everything is written to a temporary file next to the
+        output, which is renamed to the output path on close so downstream
+        jobs never see a half written file.
+    """
+    extension = None
+
+    def __init__(self, path, columns, types=None, compression=None, row_group_size=None):
+        self.path = path
+        self.columns = columns
+        self.types = types or {}
+        self.compression = compression
+        self.row_group_size = row_group_size
+        self.rows = 0
+        out_dir, name = os.path.split(os.path.abspath(path))
+        self.tmp_path = os.path.join(out_dir, f'.{name}.{os.getpid()}.tmp')
+        self._open()
+
+    def _open(self):
+        raise NotImplementedError
+
+    def _write(self, df):
+        raise NotImplementedError
+
+    def _close(self):
+        raise NotImplementedError
+
+    def write(self, df):
+        """ append a dataframe to the output """
+        self._write(df)
+        self.rows += len(df)
+
+    def close(self):
+        """ finish the output and move it to the output path """
+        self._close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        """ discard the partially written output """
+        self._close()
+        os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class CSVWriter(CombinedWriter):
+    """
+    Append dataframes to a csv, writing the header once.
+    The csv is compressed as it is written with compression
+        (gzip, bz2, xz or zstd), uncompressed by default.
+    """
+    extension = 'csv'
+
+    def _open(self):
+        self.f = open_text(self.tmp_path, self.compression)
+        self.header = True
+
+    def _write(self, df):
+        df.to_csv(self.f, index=False, header=self.header, columns=self.columns)
+        self.header = False
+
+    def close(self):
+        if self.header:
+            self.write(pd.DataFrame(columns=self.columns))
+        super().close()
+
+    def _close(self):
+        self.f.close()
+
+
+class _ArrowWriter(CombinedWriter):
+    """
+    Base class for columnar writers. Columns are written with the types
+        declared by the schema instead of as text.
+    """
+    # schema declared python types and their arrow types, others are strings
+    ARROW_TYPES = {float:'float64', int:'int64', bool:'bool_', str:'string'}
+
+    def _open(self):
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise ImportError(f'pyarrow is required for {self.extension} output, '
+                              'install it with: pip install aggregator[columnar]') from None
+        self.pa = pa
+        self.schema = pa.schema([
+            (c, getattr(pa, self.ARROW_TYPES.get(self.types.get(c), 'string'))())
+            for c in self.columns])
+
+    def _table(self, df):
+        """ return df as an arrow table with schema declared types """
+        df = df.reindex(columns=self.columns)
+        for c in self.columns:
+            if self.types.get(c) in (float, int):
+                df[c] = pd.to_numeric(df[c])
+        return self.pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+
+
+class ParquetWriter(_ArrowWriter):
+    """
+    Append dataframes to a parquet file. Each write adds row groups of at
+        most row_group_size rows, compressed with compression (snappy by
+        default).
+    """
+    extension = 'parquet'
+
+    def _open(self):
+        super()._open()
+        import pyarrow.parquet as pq
+        self.writer = pq.ParquetWriter(self.tmp_path, self.schema,
+                                       compression=self.compression or 'snappy')
+
+    def _write(self, df):
+        self.writer.write_table(self._table(df), row_group_size=self.row_group_size)
+
+    def _close(self):
+        self.writer.close()
+
+
+class FeatherWriter(_ArrowWriter):
+    """
+    Append dataframes to a feather (Arrow IPC) file. Each write adds record
+        batches of at most row_group_size rows, compressed with compression
+        (lz4 or zstd, uncompressed by default).
+    """
+    extension = 'feather'
+
+    def _open(self):
+        super()._open()
+        options = self.pa.ipc.IpcWriteOptions(compression=self.compression)
+        self.writer = self.pa.ipc.new_file(self.tmp_path, self.schema, options=options)
+
+    def _write(self, df):
+        self.writer.write_table(self._table(df), max_chunksize=self.row_group_size)
+
+    def _close(self):
+        self.writer.close()
+
+
+OUTPUT_FORMATS = {w.extension:w for w in [CSVWriter, ParquetWriter, FeatherWriter]}
+
+
+class PartitionedWriter:
+    """
+    Write dataframes to one file per value of the partition_by column,
+        in key=value directories under the output directory path (the
+        layout discovery.discover_csvs and hive style readers prune by).
+
+    Each partition is written with its own writer of output_format, and
+        rows of each write are written to their partitions in parallel on
+        a thread pool. On close a manifest (_manifest.json) listing each
+        partition's value, file and row count is written, so readers can
+        load only the partitions they need with read_partitions.
+
+    Like the single file writers, partitions are written to a temporary
+        directory next to the output, which replaces the output directory
+        on close, so partitions of an earlier run are never left behind.
+    """
+    MANIFEST = '_manifest.json'
+    # directory value of rows without a partition value
+    NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+    def __init__(self, path, columns, types=None, compression=None, row_group_size=None,
+                 partition_by=None, output_format='csv', workers=None):
+        if partition_by not in columns:
+            raise ValueError(f'Partition column {partition_by} is not a schema column')
+        self.path = path
+        self.columns = columns
+        self.writer_args = (columns, types, compression, row_group_size)
+        self.partition_by = partition_by
+        self.output_format = output_format
+        self.file_name = f'part-0.{output_format}'
+        if output_format == 'csv' and compression:
+            self.file_name += '.' + COMPRESSION_EXTENSIONS[compression]
+        # partition value -> writer
+        self.writers = {}
+        self.rows = 0
+        out_dir, name = os.path.split(os.path.abspath(path))
+        self.tmp_path = os.path.join(out_dir, f'.{name}.{os.getpid()}.tmp')
+        self.old_path = os.path.join(out_dir, f'.{name}.{os.getpid()}.old')
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def _partition_dir(self, value):
+        key = quote(self.partition_by, safe='')
+        return f'{key}={self.NULL_PARTITION if value is None else quote(value, safe="")}'
+
+    def _writer(self, value):
+        """ return the writer of a partition value, opening it on first use """
+        if value not in self.writers:
+            part_dir = os.path.join(self.tmp_path, self._partition_dir(value))
+            os.makedirs(part_dir, exist_ok=True)
+            writer = OUTPUT_FORMATS[self.output_format]
+            self.writers[value] = writer(os.path.join(part_dir, self.file_name), *self.writer_args)
+        return self.writers[value]
+
+    def write(self, df):
+        """ append rows of a dataframe to their partitions """
+        groups = df.groupby(df[self.partition_by].astype(object), dropna=False, sort=False)
+        writes = [(self._writer(None if pd.isna(value) else str(value)), group)
+                  for value, group in groups]
+        list(self.pool.map(lambda w: w[0].write(w[1]), writes))
+        self.rows += len(df)
+
+    def close(self):
+        """ finish every partition and write the manifest, then move them to the output path """
+        list(self.pool.map(lambda w: w.close(), self.writers.values()))
+        self.pool.shutdown()
+        manifest = {
+            'partition_by':self.partition_by,
+            'output_format':self.output_format,
+            'columns':self.columns,
+            'rows':self.rows,
+            'partitions':[{
+                'value':value,
+                'path':os.path.join(self._partition_dir(value), self.file_name),
+                'rows':w.rows,
+            } for value, w in sorted(self.writers.items(), key=lambda v: (v[0] is None, v[0] or ''))],
+        }
+        with open(os.path.join(self.tmp_path, self.MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=1)
+        # a non empty directory can't be replaced in one rename, so the old
+        # output is moved aside first and removed once the new one is in place
+        if os.path.exists(self.path):
+            os.rename(self.path, self.old_path)
+        os.rename(self.tmp_path, self.path)
+        shutil.rmtree(self.old_path, ignore_errors=True)
+
+    def abort(self):
+        """ discard the partially written partitions """
+        list(self.pool.map(lambda w: w.abort(), self.writers.values()))
+        self.pool.shutdown()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def read_partitions(path, values=None):
+    """
+    Read partitioned output written by PartitionedWriter, only the
+        partitions whose values are in values (None for rows without a
+        value) or all of them by default
+    """
+    with open(os.path.join(path, PartitionedWriter.MANIFEST)) as f:
+        manifest = json.load(f)
+    frames = [read_output(os.path.join(path, p['path'])) for p in manifest['partitions']
+              if values is None or p['value'] in values]
+    if not frames:
+        return pd.DataFrame(columns=manifest['columns'])
+    return pd.concat(frames, ignore_index=True)
+
+def read_output(path):
+    """
+    Read a combined or quarantine output written by one of the writers,
+        chosen by its file extension. csvs are read as strings.
+    """
+    ext = os.path.basename(path).split('.')[1:]
+    if 'parquet' in ext:
+        return pd.read_parquet(path)
+    elif 'feather' in ext:
+        return pd.read_feather(path)
+    return pd.read_csv(path, dtype=str, compression=detect_compression(path))
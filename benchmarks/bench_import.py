@@ -0,0 +1,55 @@
+"""
+Benchmark startup cost of the aggregate command line utility.
+
+Imports aggregator.aggregate in fresh interpreters with python -X importtime
+and reports the median total import time and the slowest imported modules.
+Run from the directory containing the aggregator package:
+
+    python3 benchmarks/bench_import.py --runs=10 --max_ms=1000
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+
+
+def import_times(module):
+    """
+    Import module in a fresh interpreter, returning a map of
+        imported module name to cumulative import time in microseconds
+    """
+    cmd = [sys.executable, '-X', 'importtime', '-c', f'import {module}']
+    result = subprocess.run(cmd, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark import time of the aggregator CLI', add_help=True)
+    parser.add_argument('--module', type=str, default='aggregator.aggregate', help='module to import')
+    parser.add_argument('--runs', type=int, default=5, help='number of fresh interpreters to time')
+    parser.add_argument('--top', type=int, default=10, help='number of slowest modules to show')
+    parser.add_argument('--max_ms', type=float, default=None, help='exit with an error if median import time is higher')
+    args = parser.parse_args()
+
+    runs = [import_times(args.module) for _ in range(args.runs)]
+    total_ms = statistics.median(r[args.module] for r in runs) / 1000
+    print(f'{args.module} median import time over {args.runs} runs: {total_ms:.1f} ms\n')
+
+    # modules with the highest cumulative import time in the last run
+    last = runs[-1]
+    slowest = sorted((t, n) for n, t in last.items() if n != args.module)[::-1][:args.top]
+    for t, name in slowest:
+        print(f'{t/1000:>10.1f} ms  {name}')
+
+    if args.max_ms is not None and total_ms > args.max_ms:
+        sys.exit(f'import time {total_ms:.1f} ms is over the {args.max_ms} ms budget')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+Benchmark the validate and combine pipeline on synthetic partner csvs.
+
+Generates GeneralSchema shaped csvs with generate_data.py, then times each
+stage separately: reading and validating every csv with AggCSV, printing
+their errors, Combine.combine_csvs, and Combine.write_combined_csv. Each
+stage reports its median time, rows per second, and peak memory allocated
+(measured in one extra run under tracemalloc). Run from the directory
+containing the aggregator package:
+
+    python3 benchmarks/bench_pipeline.py --files=50 --rows=10000 --save_baseline=baseline.json
+    python3 benchmarks/bench_pipeline.py --files=50 --rows=10000 --baseline=baseline.json --max_slowdown=1.2
+"""
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.getcwd())
+
+from aggregator.aggregate import AggCSV, Combine
+from generate_data import generate_csvs
+
+
+def measure(func, runs):
+    """
+    Run func runs times, returning the median seconds and the peak
+        megabytes allocated by one more run traced with tracemalloc
+    """
+    seconds = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return statistics.median(seconds), peak / 2**20
+
+
+def stages(csvs_path, output_dir, kwargs):
+    """ return a map of stage name to a function running that stage """
+    csvs = [os.path.join(csvs_path, f) for f in sorted(os.listdir(csvs_path))]
+    schema_cols = Combine('general', csvs_path).schema_cols
+    validate_kwargs = {k:kwargs[k] for k in ('vectorized', 'dedup')}
+
+    def validate():
+        return [AggCSV('general', csv, schema_cols).validate(**validate_kwargs) for csv in csvs]
+
+    validated = []
+    for csv in csvs:
+        a = AggCSV('general', csv, schema_cols)
+        a.validate(**validate_kwargs)
+        validated.append(a)
+
+    def print_errors():
+        for a in validated:
+            a.print_errors()
+
+    def combine():
+        Combine('general', csvs_path, **kwargs).combine_csvs()
+
+    combined = Combine('general', csvs_path, **kwargs)
+    combined.combine_csvs()
+
+    def write():
+        combined.write_combined_csv(os.path.join(output_dir, 'combined.csv'))
+
+    return {
+        'AggCSV.validate':validate,
+        'AggCSV.print_errors':print_errors,
+        'Combine.combine_csvs':combine,
+        'Combine.write_combined_csv':write,
+    }
+
+
+def compare(results, baseline, max_slowdown):
+    """
+    Print the change of each stage from baseline, returning the stages
+        more than max_slowdown times slower
+    """
+    slower = []
+    print(f'\n{"stage":<28}{"baseline s":>12}{"change":>10}')
+    for stage, r in results.items():
+        if stage not in baseline['stages']:
+            continue
+        base = baseline['stages'][stage]['seconds']
+        ratio = r['seconds'] / base
+        print(f'{stage:<28}{base:>12.3f}{ratio - 1:>+10.1%}')
+        if max_slowdown is not None and ratio > max_slowdown:
+            slower.append(stage)
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark validating and combining synthetic csvs', add_help=True)
+    parser.add_argument('--files', type=int, default=20, help='number of csvs')
+    parser.add_argument('--rows', type=int, default=5000, help='rows per csv')
+    parser.add_argument('--error_rate', type=float, default=0.01, help='share of rows with an invalid value')
+    parser.add_argument('--cardinality', type=int, default=50, help='distinct providers, campaigns and domains')
+    parser.add_argument('--line_terminator', type=str, default='mixed', choices=['lf', 'crlf', 'mixed'],
+                        help='line endings of the csvs')
+    parser.add_argument('--runs', type=int, default=3, help='timed runs of each stage')
+    parser.add_argument('--vectorized', action='store_true', help='validate whole columns at once')
+    parser.add_argument('--dedup', action='store_true', help='validate each distinct value once')
+    parser.add_argument('--workers', type=int, default=1, help='processes used by Combine')
+    parser.add_argument('--save_baseline', type=str, default=None, help='write results to this json file')
+    parser.add_argument('--baseline', type=str, default=None, help='compare results to this json file')
+    parser.add_argument('--max_slowdown', type=float, default=None,
+                        help='exit with an error if a stage is this many times slower than the baseline')
+    args = parser.parse_args()
+
+    params = {k:getattr(args, k) for k in ('files', 'rows', 'error_rate', 'cardinality',
+                                           'line_terminator', 'vectorized', 'dedup', 'workers')}
+    kwargs = {'vectorized':args.vectorized, 'dedup':args.dedup, 'workers':args.workers}
+    end = {'lf':'\n', 'crlf':'\r\n', 'mixed':'mixed'}[args.line_terminator]
+    total_rows = args.files * args.rows
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        csvs_path = os.path.join(tmp, 'csvs')
+        generate_csvs(csvs_path, args.files, args.rows, args.error_rate, args.cardinality, end)
+        # stages print errors and output paths, which are not benchmarked
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            for stage, func in stages(csvs_path, tmp, kwargs).items():
+                seconds, peak_mb = measure(func, args.runs)
+                results[stage] = {'seconds':seconds, 'rows_per_sec':total_rows / seconds,
+                                  'peak_mb':peak_mb}
+
+    print(f'{args.files} csvs of {args.rows} rows, median of {args.runs} runs\n')
+    print(f'{"stage":<28}{"seconds":>10}{"rows/sec":>12}{"peak MB":>10}')
+    for stage, r in results.items():
+        print(f'{stage:<28}{r["seconds"]:>10.3f}{r["rows_per_sec"]:>12,.0f}{r["peak_mb"]:>10.1f}')
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'params':params, 'stages':results}, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['params'] != params:
+            print(f'\nbaseline was run with different parameters: {baseline["params"]}')
+        slower = compare(results, baseline, args.max_slowdown)
+        if slower:
+            sys.exit(f'stages over {args.max_slowdown}x slower than baseline: {", ".join(slower)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Generate synthetic partner csvs shaped like GeneralSchema for benchmarks.
+
+Row and file counts, the share of rows with an invalid value, line
+terminators, and the number of distinct values of low cardinality columns
+can all be tuned. The same seed always generates the same files:
+
+    python3 benchmarks/generate_data.py --output_dir=/tmp/agg_data --files=100 --rows=10000
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+# invalid values for each column, as partners have been seen to send them
+INVALID_VALUES = {
+    'Cost Per Ad Click':['0', 'free', '$0.00'],
+    'Redirect Link':['wont work', 'http//broken', 'nolink'],
+    'Phone Number':['12345', '555-55', '1-800-CALL-NOW'],
+    'Zipcode':['7876510', '787', 'ABCDE'],
+    'Address':['   '],
+    'Provider Name':['null', 'N/A'],
+}
+
+STREETS = ['Burton Street', 'tim street', 'MAIN   ST', 'elm ave', 'Lamar Blvd', 'congress ave']
+
+
+def generate_df(rows, error_rate=0.01, cardinality=50, seed=0):
+    """
+    Return a dataframe of rows GeneralSchema shaped rows as strings.
+    error_rate of the rows have one invalid value, and provider names,
+        campaign ids and redirect domains have cardinality distinct values.
+    """
+    rng = np.random.default_rng(seed)
+    pick = lambda values: np.asarray(values, dtype=object)[rng.integers(0, len(values), rows)]
+    numbers = lambda low, high: rng.integers(low, high, rows).astype(str).astype(object)
+    providers = [f'Partner {i} Insurance' for i in range(cardinality)]
+    campaigns = [f'camp{i}' for i in range(cardinality)]
+    domains = [f'partner{i}.com' for i in range(cardinality)]
+
+    phones = numbers(10**9, 10**10)
+    short = rng.random(rows) < 0.3
+    phones[short] = [p[:7] for p in phones[short]]
+
+    df = pd.DataFrame({
+        'Provider Name':pick(providers),
+        'CampaignID':pick(campaigns),
+        'Cost Per Ad Click':[f'"{c:.2f}"' for c in rng.uniform(0.05, 50, rows)],
+        'Redirect Link':pick(domains) + '/ad' + numbers(0, 100),
+        'Phone Number':phones,
+        'Address':numbers(1, 9999) + ' ' + pick(STREETS),
+        'Zipcode':[f'"{z:05d}"' for z in rng.integers(10000, 99999, rows)],
+    })
+    df.loc[rng.random(rows) < 0.05, 'Phone Number'] = None
+
+    # replace one value of each errored row with an invalid value
+    errors = np.flatnonzero(rng.random(rows) < error_rate)
+    columns = list(INVALID_VALUES)
+    for row, c in zip(errors, rng.integers(0, len(columns), len(errors))):
+        col = columns[c]
+        df.at[row, col] = INVALID_VALUES[col][rng.integers(0, len(INVALID_VALUES[col]))]
+    return df
+
+
+def generate_csvs(output_dir, files=10, rows=1000, error_rate=0.01, cardinality=50,
+                  line_terminator='\n', seed=0):
+    """
+    Write files synthetic csvs of rows rows each to output_dir and return
+        their paths. line_terminator 'mixed' alternates '\\n' and '\\r\\n'.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for i in range(files):
+        df = generate_df(rows, error_rate, cardinality, seed + i)
+        end = line_terminator
+        if line_terminator == 'mixed':
+            end = '\r\n' if i % 2 == 0 else '\n'
+        path = os.path.join(output_dir, f'partner_{i:05d}.csv')
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            df.to_csv(f, index=False, line_terminator=end)
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic GeneralSchema csvs', add_help=True)
+    parser.add_argument('--output_dir', type=str, required=True, help='directory to write csvs to')
+    parser.add_argument('--files', type=int, default=10, help='number of csvs')
+    parser.add_argument('--rows', type=int, default=1000, help='rows per csv')
+    parser.add_argument('--error_rate', type=float, default=0.01, help='share of rows with an invalid value')
+    parser.add_argument('--cardinality', type=int, default=50, help='distinct providers, campaigns and domains')
+    parser.add_argument('--line_terminator', type=str, default='lf', choices=['lf', 'crlf', 'mixed'],
+                        help='line endings of the csvs, mixed alternates between files')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    end = {'lf':'\n', 'crlf':'\r\n', 'mixed':'mixed'}[args.line_terminator]
+    paths = generate_csvs(args.output_dir, args.files, args.rows, args.error_rate,
+                          args.cardinality, end, args.seed)
+    print(f'wrote {len(paths)} csvs of {args.rows} rows to {os.path.abspath(args.output_dir)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -9,8 +9,15 @@ setup(
    description='Module to combine csv files from partners, and clean data in the process',
    author='Russell Peck',
    author_email='peck.russell@gmail.com',
-   packages=find_packages(),
+   packages=find_packages(exclude=['tests', 'tests.*']),
+   entry_points={
+       'aggregator.schemas':['general = aggregator.schema:GeneralSchema'],
+   },
    install_requires=required,
+   extras_require={
+       'columnar':['pyarrow'],
+       'zstd':['zstandard'],
+   },
    url="<https://github.com/rpeckv2/aggregator>",
    classifiers=[
         "Programming Language :: Python :: 3",
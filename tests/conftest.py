@@ -4,7 +4,9 @@ import pytest
 import pandas as pd
 
 from aggregator.schema import Validation
+from aggregator.utilities import register_schema
 
+@register_schema('test')
 class TestSchema(Validation):
     """ test schema class that inherits the Validation super class """
     test_attr1 = {
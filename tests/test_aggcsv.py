@@ -1,6 +1,7 @@
 import pprint
 
 import pytest
+import pandas as pd
 
 from aggregator.aggregate import AggCSV
 
@@ -41,5 +42,147 @@ def test_captured_errors(tmpdir, supply_generalSchema_data):
     a.validate()
     for i, err in enumerate(a.errors):
         err[0] = err[0].split('/')[-1]
-        # exclude comparing dataframe as last entry
-        assert err[:-1] == results[i]
+        assert err == results[i]
+
+def test_vectorized_matches_per_cell(tmpdir, supply_generalSchema_data):
+    """ test vectorized and deduplicated validation produce the same
+    cleaned data and errors as per-cell validation """
+
+    csvs = ['./tests/csv_files/auto_insurance_data.csv',
+            './tests/csv_files/home_insurance_data.csv']
+    for i, df in enumerate(supply_generalSchema_data):
+        df_loc = str(tmpdir.join(f'test_csv{i}'))
+        df.to_csv(df_loc, index=False)
+        csvs.append(df_loc)
+
+    for csv in csvs:
+        a = AggCSV('general', csv)
+        a.validate()
+        for kwargs in [{'vectorized':True}, {'dedup':True}, {'vectorized':True, 'dedup':True}]:
+            b = AggCSV('general', csv)
+            b.validate(**kwargs)
+
+            assert a.rows_w_errors == b.rows_w_errors
+            assert a.distinct_cols_w_errors == b.distinct_cols_w_errors
+            # compare as strings so NaN values are considered equal
+            assert str(list(a.errors)) == str(list(b.errors))
+            pd.testing.assert_frame_equal(a.df, b.df)
+
+def test_print_errors_distinct_sorted_rows(tmpdir, capsys):
+    """ test each row with errors is printed once, in row order """
+    df = pd.DataFrame({
+        'Provider Name':['p1', 'p2', 'p3', 'p4'],
+        'CampaignID':['c1', 'c2', 'c3', 'c4'],
+        'Cost Per Ad Click':[0, 1, 1, 0],
+        'Redirect Link':['bad link', 'a.com', 'b.com', 'bad link'],
+        'Phone Number':['5555555', '5555555', '5555555', '5555555'],
+        'Address':['a', 'b', 'c', 'd'],
+        'Zipcode':['1', '78752', '78752', '1'],
+    })
+    df_loc = str(tmpdir.join('test_csv0'))
+    df.to_csv(df_loc, index=False)
+
+    a = AggCSV('general', df_loc, list(df.columns))
+    a.validate()
+    a.print_errors()
+    out = capsys.readouterr().out
+
+    assert a.err_df.index.tolist() == [0, 3]
+    assert out.count('bad link') == 2
+    assert out.index('p1') < out.index('p4')
+
+def test_validate_chunks_matches_validate(tmpdir, supply_generalSchema_data):
+    """ test streaming a csv in chunks gives the same cleaned rows
+    and globally numbered errors as validating it whole """
+    df = pd.concat(supply_generalSchema_data, ignore_index=True)
+    df_loc = str(tmpdir.join('test_csv0'))
+    df.to_csv(df_loc, index=False)
+
+    a = AggCSV('general', df_loc)
+    a.validate()
+    b = AggCSV('general', df_loc, chunksize=4)
+    chunks = list(b.validate_chunks())
+
+    assert len(chunks) == 6
+    assert a.rows_w_errors == b.rows_w_errors
+    assert a.distinct_cols_w_errors == b.distinct_cols_w_errors
+    # errors are ordered by chunk first, compare them ordered by row
+    by_row = lambda errors: str(sorted(errors, key=lambda e: e[2]))
+    assert by_row(a.errors) == by_row(b.errors)
+    assert a.err_df.index.tolist() == b.err_df.index.tolist()
+    pd.testing.assert_frame_equal(a.df.astype(str), pd.concat(chunks).astype(str))
+
+@pytest.mark.parametrize('chunksize', [None, 4])
+def test_read_schema_columns(tmpdir, supply_generalSchema_data, chunksize):
+    """ test only schema columns are read, with header variations
+    renamed to the schema names """
+    df = pd.concat(supply_generalSchema_data, ignore_index=True)
+    cols = df.columns.tolist()
+    wide = df.rename(columns={'Cost Per Ad Click':'cost_per_ad_click', 'CampaignID':' CAMPAIGN-ID'})
+    for i in range(20):
+        wide[f'Extra {i}'] = 'x'
+    wide_loc = str(tmpdir.join('wide.csv'))
+    wide.to_csv(wide_loc, index=False)
+    df_loc = str(tmpdir.join('narrow.csv'))
+    df.to_csv(df_loc, index=False)
+
+    a = AggCSV('general', df_loc, cols, chunksize)
+    w = AggCSV('general', wide_loc, cols, chunksize)
+    if chunksize:
+        a.df, w.df = pd.concat(list(a.validate_chunks())), pd.concat(list(w.validate_chunks()))
+    else:
+        a.validate()
+        w.validate()
+
+    assert sorted(w.df.columns) == sorted(cols)
+    pd.testing.assert_frame_equal(a.df.astype(str), w.df[a.df.columns].astype(str))
+    assert a.rows_w_errors == w.rows_w_errors
+
+@pytest.mark.parametrize('chunksize', [None, 50])
+def test_error_budget_quarantine(tmpdir, supply_generalSchema_data, chunksize):
+    """ test a csv over its error budget on a sample is quarantined
+    without being validated, and one under it is validated """
+    df = pd.concat([supply_generalSchema_data[0]] * 40, ignore_index=True)
+    df_loc = str(tmpdir.join('test_csv0'))
+    df.to_csv(df_loc, index=False)
+
+    def validate(**kwargs):
+        a = AggCSV('general', df_loc, chunksize=chunksize)
+        rows = list(a.validate_chunks(**kwargs)) if chunksize else a.validate(**kwargs)
+        return a, rows
+
+    # 2 of every 5 rows have errors
+    a, rows = validate(max_error_rate=0.2, sample_rows=20)
+    assert a.quarantine_reason.endswith('rows with errors, more than 20.0%')
+    assert len(a.errors) == 0 and len(a.err_df) == 0
+    assert 'validate' not in a.stats.stages
+    if chunksize:
+        assert rows == []
+
+    a, _ = validate(max_errors=5, sample_rows=20)
+    assert a.quarantine_reason.endswith('rows with errors, more than 5')
+
+    a, _ = validate(max_error_rate=0.5, sample_rows=20)
+    assert a.quarantine_reason is None
+    assert len(a.rows_w_errors) == 80
+
+def test_missing_columns_quarantine(tmpdir, supply_generalSchema_data):
+    """ test a csv read with the wrong delimiter is quarantined """
+    df_loc = str(tmpdir.join('test_csv0'))
+    supply_generalSchema_data[0].to_csv(df_loc, index=False, sep='|')
+
+    a = AggCSV('general', df_loc)
+    a.validate()
+    assert a.quarantine_reason.startswith('missing columns Address, CampaignID')
+    assert len(a.df) == 0
+
+def test_sample_only(tmpdir, supply_generalSchema_data):
+    """ test sample_only validates only sample_rows rows """
+    df = pd.concat([supply_generalSchema_data[0]] * 40, ignore_index=True)
+    df_loc = str(tmpdir.join('test_csv0'))
+    df.to_csv(df_loc, index=False)
+
+    a = AggCSV('general', df_loc)
+    a.validate(sample_only=True, sample_rows=50)
+    assert a.stats.stages['validate'][1] == 50
+    assert len(a.df) + len(a.rows_w_errors) == 50
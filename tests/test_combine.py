@@ -1,8 +1,15 @@
+import json
+import os
+
 import pytest
 import pandas as pd
 
 from aggregator.aggregate import Combine
+from aggregator import schema
+from aggregator.discovery import PartitionFilter, discover_csvs
 from aggregator.schema import GeneralSchema
+from aggregator.utilities import df_memory_mb
+from aggregator.writers import read_partitions
 
 # many of these tests are not strictly unit tests, many are used to spot
 # check that the output and generated CSV files "look" correct
@@ -32,6 +39,103 @@ def test_combine_csvs(tmpdir, supply_generalSchema_data):
     c.combine_csvs()
     c.print_summary()
     assert len(c.master_df) == 13
+    assert c.master_df.index.tolist() == list(range(13))
+    assert c.master_df.columns.tolist() == c.schema_cols
+
+def test_combine_csvs_workers(tmpdir, supply_generalSchema_data):
+    """ test validating csvs in a process pool gives the same
+    combined output and totals as a serial run """
+
+    for i, df in enumerate(supply_generalSchema_data):
+        df_loc = str(tmpdir.join(f'test_csv_{i}.csv'))
+        df.to_csv(df_loc, index=False)
+    csv_loc = str(tmpdir)
+
+    serial = Combine('general', csv_loc)
+    serial.combine_csvs()
+    parallel = Combine('general', csv_loc, workers=2)
+    parallel.combine_csvs()
+
+    pd.testing.assert_frame_equal(serial.master_df, parallel.master_df)
+    assert serial.total_rows_w_errors == parallel.total_rows_w_errors
+    assert serial.total_csvs_w_errors == parallel.total_csvs_w_errors
+    assert serial.distinct_cols_w_errors == parallel.distinct_cols_w_errors
+
+def test_combine_csvs_prefetch(tmpdir, supply_generalSchema_data):
+    """ test prefetching csvs on threads gives the same result as reading
+    them one at a time, and entries that are not csvs are skipped """
+    csv_loc = tmpdir.mkdir('csvs')
+    for i, df in enumerate(supply_generalSchema_data):
+        df.to_csv(str(csv_loc.join(f'test_csv_{i}.csv')), index=False)
+    csv_loc.join('README.txt').write('not a csv')
+    supply_generalSchema_data[0].to_csv(str(csv_loc.join('test_csv_0.csv.bak')), index=False)
+    csv_loc.join('.test_csv_0.csv.1234.tmp').write('partial output')
+    csv_loc.mkdir('archive.csv')
+
+    serial = Combine('general', str(csv_loc), prefetch=0)
+    serial.combine_csvs()
+    for prefetch in [1, 3]:
+        prefetched = Combine('general', str(csv_loc), prefetch=prefetch)
+        prefetched.combine_csvs()
+        pd.testing.assert_frame_equal(serial.master_df, prefetched.master_df)
+        assert prefetched.total_csvs == len(supply_generalSchema_data)
+        assert prefetched.total_rows_w_errors == serial.total_rows_w_errors
+
+    only = Combine('general', str(csv_loc), pattern='test_csv_[12].csv')
+    only.combine_csvs()
+    assert only.total_csvs == 2
+
+def test_combine_partitioned_csvs(tmpdir, supply_generalSchema_data, monkeypatch):
+    """ test csvs are found recursively, or from a glob, and partition
+    directories that don't pass the filters are never listed """
+    root = tmpdir.mkdir('landing')
+    dates = ['2024-01-01', '2024-02-01', '2024-03-01']
+    for i, df in enumerate(supply_generalSchema_data):
+        partner = root.join(f'partner=p{i % 2}')
+        for date in dates:
+            df.to_csv(str(partner.ensure(f'date={date}', dir=True).join(f'test_csv_{i}.csv')), index=False)
+
+    c = Combine('general', str(root), recursive=True)
+    assert len(c._list_csvs()) == len(supply_generalSchema_data) * len(dates)
+    assert Combine('general', str(root))._list_csvs() == []
+
+    listed = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', lambda path: listed.append(path) or scandir(path))
+    c = Combine('general', str(root), recursive=True,
+                partition_filters=['date>=2024-02-01', 'partner!=p1'])
+    c.combine_csvs()
+    assert c.total_csvs == 6
+    assert not any('date=2024-01-01' in p or 'partner=p1' in p for p in listed)
+
+    g = Combine('general', str(root) + '/partner=p0/date=2024-03*')
+    assert g._list_csvs() == sorted(p for p in c._list_csvs() if 'date=2024-03-01' in p)
+    with pytest.raises(ValueError, match='not of the form'):
+        Combine('general', str(root), partition_filters=['date~2024'])
+
+def test_combine_missing_csvs_path(tmpdir):
+    """ test a csvs_path that doesn't exist, or a glob matching nothing,
+    raises instead of combining nothing """
+    with pytest.raises(FileNotFoundError, match='does not exist'):
+        Combine('general', str(tmpdir.join('does_not_exist'))).combine_csvs()
+    with pytest.raises(FileNotFoundError, match='No files or directories match'):
+        Combine('general', str(tmpdir.join('partner=*'))).combine_csvs()
+
+def test_combine_csvs_chunksize(tmpdir, supply_generalSchema_data):
+    """ test streaming csvs in chunks gives the same combined rows """
+
+    for i, df in enumerate(supply_generalSchema_data):
+        df_loc = str(tmpdir.join(f'test_csv_{i}.csv'))
+        df.to_csv(df_loc, index=False)
+    csv_loc = str(tmpdir)
+
+    whole = Combine('general', csv_loc)
+    whole.combine_csvs()
+    for workers in [1, 2]:
+        chunked = Combine('general', csv_loc, workers=workers, chunksize=2)
+        chunked.combine_csvs()
+        pd.testing.assert_frame_equal(whole.master_df.astype(str), chunked.master_df.astype(str))
+        assert whole.total_rows_w_errors == chunked.total_rows_w_errors
 
 def test_write_combined_csv(tmpdir, supply_generalSchema_data):
     """ test combined csv is successfully written to working directory"""
@@ -53,6 +157,362 @@ def test_write_combined_csv(tmpdir, supply_generalSchema_data):
     c.write_combined_csv(output_loc)
     c.print_summary()
 
+def test_stream_combined_csv(tmpdir, supply_generalSchema_data):
+    """ test streaming csvs to the output gives the same csv as
+    combining them in memory first """
+
+    csv_loc = tmpdir.mkdir('csvs')
+    for i, df in enumerate(supply_generalSchema_data):
+        df.to_csv(str(csv_loc.join(f'test_csv_{i}.csv')), index=False)
+
+    output_loc = str(tmpdir.join('combined_output.csv'))
+    c = Combine('general', str(csv_loc))
+    c.combine_csvs()
+    c.write_combined_csv(output_loc)
+
+    stream_loc = str(tmpdir.join('streamed_output.csv'))
+    s = Combine('general', str(csv_loc), chunksize=2)
+    s.stream_combined_csv(stream_loc)
+
+    assert len(s.master_df) == 0
+    assert s.total_rows == c.total_rows == 13
+    with open(output_loc) as f, open(stream_loc) as g:
+        assert f.read() == g.read()
+    assert sorted(p.basename for p in tmpdir.listdir()) == [
+        'combined_output.csv', 'csvs', 'streamed_output.csv']
+
+def test_write_combined_csv_directory(tmpdir):
+    """ test combined csv is given the default name in an output directory """
+    c = Combine('general', './tests/csv_files')
+    c.combine_csvs()
+    c.write_combined_csv(str(tmpdir))
+
+    written = [p.basename for p in tmpdir.listdir()]
+    assert len(written) == 1
+    assert written[0].startswith('AggIns_combined_csvs_')
+    result = pd.read_csv(str(tmpdir.join(written[0])))
+    assert result.columns.tolist() == c.schema_cols
+    assert len(result) == c.total_rows
+
+@pytest.mark.parametrize('compression', ['gzip', 'bz2', 'xz', 'zstd'])
+def test_combine_compressed_csvs(tmpdir, supply_generalSchema_data, compression):
+    """ test compressed csvs are read and written like plain csvs """
+    if compression == 'zstd':
+        pytest.importorskip('zstandard')
+
+    plain_loc = tmpdir.mkdir('plain')
+    comp_loc = tmpdir.mkdir('compressed')
+    for i, df in enumerate(supply_generalSchema_data):
+        df.to_csv(str(plain_loc.join(f'test_csv_{i}.csv')), index=False)
+        df.to_csv(str(comp_loc.join(f'test_csv_{i}.csv.gz')), index=False,
+                  compression=compression)
+
+    c = Combine('general', str(plain_loc))
+    c.combine_csvs()
+    z = Combine('general', str(comp_loc), compression=compression)
+    z.combine_csvs()
+    pd.testing.assert_frame_equal(c.master_df, z.master_df)
+
+    out_dir = tmpdir.mkdir('out')
+    z.write_combined_csv(str(out_dir))
+    written = [p.basename for p in out_dir.listdir()]
+    assert len(written) == 1
+    assert written[0].endswith('.csv.' + {'gzip':'gz', 'zstd':'zst'}.get(compression, compression))
+    result = pd.read_csv(str(out_dir.join(written[0])), dtype=str, compression=compression)
+    assert result.columns.tolist() == z.schema_cols
+    assert len(result) == z.total_rows
+
+def test_combine_csvs_compact(tmpdir, supply_generalSchema_data):
+    """ test compact combined data has schema dtypes, the same values,
+    and uses less memory """
+    csv_loc = tmpdir.mkdir('csvs')
+    for i in range(20):
+        df = supply_generalSchema_data[i % len(supply_generalSchema_data)]
+        df.to_csv(str(csv_loc.join(f'test_csv_{i}.csv')), index=False)
+
+    c = Combine('general', str(csv_loc))
+    c.combine_csvs()
+    s = Combine('general', str(csv_loc), compact=True)
+    s.combine_csvs()
+    s.print_summary()
+
+    assert s.master_df['Cost Per Ad Click'].dtype == 'float64'
+    assert s.master_df['Provider Name'].dtype == 'category'
+    assert s.memory_mb_before_compact > df_memory_mb(s.master_df)
+    pd.testing.assert_frame_equal(c.master_df.astype(str), s.master_df.astype(str))
+
+def test_combine_stats(tmpdir, supply_generalSchema_data):
+    """ test time and rows of each stage, csv and rule are recorded """
+    csv_loc = tmpdir.mkdir('csvs')
+    for i, df in enumerate(supply_generalSchema_data):
+        df.to_csv(str(csv_loc.join(f'test_csv_{i}.csv')), index=False)
+
+    c = Combine('general', str(csv_loc))
+    c.combine_csvs()
+    c.write_combined_csv(str(tmpdir.join('combined_output.csv')))
+    metrics_loc = str(tmpdir.join('metrics.json'))
+    c.stats.write_json(metrics_loc)
+    with open(metrics_loc) as f:
+        metrics = json.load(f)
+
+    stages = metrics['stages']
+    assert stages['read']['rows'] == stages['validate']['rows'] == 22
+    assert stages['concat']['rows'] == stages['write']['rows'] == c.total_rows
+    assert stages['error_rows']['rows'] == c.total_rows_w_errors
+    assert all(m['seconds'] >= 0 for m in stages.values())
+    assert len(metrics['files']) == len(supply_generalSchema_data)
+    assert set(metrics['rules']) == set(c.schema_cols)
+    assert metrics['rules']['Zipcode']['valid_zipcode']['values'] == 22
+
+@pytest.mark.parametrize('extension', ['jsonl', 'parquet'])
+def test_combine_error_output(tmpdir, supply_generalSchema_data, capsys, extension):
+    """ test every error is written to the error output, and console
+    output is limited to max_printed_errors rows """
+    if extension == 'parquet':
+        pytest.importorskip('pyarrow')
+    csv_loc = tmpdir.mkdir('csvs')
+    for i, df in enumerate(supply_generalSchema_data):
+        df.to_csv(str(csv_loc.join(f'test_csv_{i}.csv')), index=False)
+
+    error_loc = str(tmpdir.join(f'errors.{extension}'))
+    c = Combine('general', str(csv_loc), error_output=error_loc, max_printed_errors=2)
+    c.combine_csvs()
+    out = capsys.readouterr().out
+
+    if extension == 'jsonl':
+        errors = pd.read_json(error_loc, lines=True)
+    else:
+        errors = pd.read_parquet(error_loc)
+    assert errors.columns.tolist() == ['csv_path', 'column', 'row', 'rule', 'value']
+    assert len(errors) >= c.total_rows_w_errors
+    assert set(errors['column']) == c.distinct_cols_w_errors
+    assert errors.groupby('csv_path')['row'].nunique().sum() == c.total_rows_w_errors
+    assert c.total_printed_errors == 2
+    assert out.count('Printed 2 rows with errors') == 1
+
+@pytest.mark.parametrize('workers,chunksize', [(1, None), (1, 100), (2, None), (2, 100)])
+def test_combine_quarantine(tmpdir, supply_generalSchema_data, capsys, workers, chunksize):
+    """ test csvs over the error budget are left out of the combined
+    data and reported in the summary """
+    csv_loc = tmpdir.mkdir('csvs')
+    for i, df in enumerate(supply_generalSchema_data):
+        df.to_csv(str(csv_loc.join(f'test_csv_{i}.csv')), index=False)
+    supply_generalSchema_data[0].to_csv(str(csv_loc.join('broken.csv')), index=False, sep=';')
+
+    c = Combine('general', str(csv_loc), max_error_rate=0.5, workers=workers, chunksize=chunksize)
+    c.combine_csvs()
+    c.print_summary()
+    out = capsys.readouterr().out
+
+    # test_csv_1 is a single row with errors
+    assert sorted(os.path.basename(p) for p in c.quarantined_csvs) == ['broken.csv', 'test_csv_1.csv']
+    assert c.quarantined_csvs[str(csv_loc) + '/broken.csv'].startswith('missing columns')
+    assert c.total_csvs == 7
+    assert 'Total CSVs Quarantined             : 2' in out
+    os.remove(str(csv_loc.join('broken.csv')))
+    full = Combine('general', str(csv_loc))
+    full.combine_csvs()
+    assert c.total_rows == full.total_rows
+    assert c.total_rows_w_errors == full.total_rows_w_errors - 1
+
+@pytest.mark.parametrize('extension', ['csv', 'parquet'])
+def test_quarantine_output_reingest(tmpdir, supply_generalSchema_data, extension, monkeypatch):
+    """ test rejected rows are written to the quarantine output with their
+    errors, and corrected rows are reingested into the combined output """
+    if extension == 'parquet':
+        pytest.importorskip('pyarrow')
+    csv_loc = tmpdir.mkdir('csvs')
+    for i, df in enumerate(supply_generalSchema_data):
+        df.to_csv(str(csv_loc.join(f'test_csv_{i}.csv')), index=False)
+
+    quarantine_loc = str(tmpdir.join(f'quarantine.{extension}'))
+    output_loc = str(tmpdir.join(f'combined.{extension}'))
+    c = Combine('general', str(csv_loc), quarantine_output=quarantine_loc, output_format=extension)
+    c.combine_csvs()
+    c.write_combined_csv(output_loc)
+
+    read = pd.read_csv if extension == 'csv' else pd.read_parquet
+    quarantined = read(quarantine_loc)
+    assert quarantined.columns.tolist() == c.schema_cols + ['_csv_path', '_row', '_errors']
+    assert len(quarantined) == c.total_rows_w_errors
+    redirect = quarantined['_errors'].str.contains('Redirect Link:valid_redirect_link')
+    assert redirect.any()
+
+    # correct the redirect links, other rows still fail
+    quarantined.loc[redirect, 'Redirect Link'] = 'fixed.com'
+    quarantined.loc[redirect, '_errors'] = None
+    fixed_loc = str(tmpdir.join(f'fixed.{extension}'))
+    if extension == 'csv':
+        quarantined.to_csv(fixed_loc, index=False)
+    else:
+        quarantined.astype(str).to_parquet(fixed_loc)
+
+    requarantine_loc = str(tmpdir.join(f'requarantine.{extension}'))
+    r = Combine('general', quarantine_output=requarantine_loc, output_format=extension)
+    with pytest.raises(ValueError, match='must be a file'):
+        r.reingest_quarantine(fixed_loc, str(tmpdir))
+    # a failed reingest leaves the combined output as it was
+    with open(output_loc, 'rb') as f:
+        before = f.read()
+    def crash(df, f, **kwargs):
+        f.write('partial,row')
+        raise ZeroDivisionError
+    with monkeypatch.context() as m:
+        if extension == 'csv':
+            m.setattr(pd.DataFrame, 'to_csv', crash)
+        else:
+            m.setattr('aggregator.writers.ParquetWriter._write', lambda *args: 1 / 0)
+        with pytest.raises(ZeroDivisionError):
+            Combine('general', output_format=extension).reingest_quarantine(fixed_loc, output_loc)
+    with open(output_loc, 'rb') as f:
+        assert f.read() == before
+    r.reingest_quarantine(fixed_loc, output_loc)
+    assert not [p for p in os.listdir(str(tmpdir)) if p.startswith('.')]
+    combined = read(output_loc)
+    assert len(combined) == c.total_rows + r.total_rows
+    assert r.total_rows == len(r.master_df) > 0
+    assert (combined['Redirect Link'] == 'fixed.com').sum() == r.total_rows
+    requarantined = read(requarantine_loc)
+    assert len(requarantined) == len(quarantined) - r.total_rows
+    # rows that fail again still point at the partner csv and row they came from
+    source = lambda df: set(zip(df['_csv_path'], df['_row'].astype(str)))
+    assert source(requarantined) <= source(quarantined)
+    assert requarantined['_csv_path'].str.startswith(str(csv_loc)).all()
+
+@pytest.mark.parametrize('output_format', ['csv', 'parquet'])
+def test_write_partitioned_output(tmpdir, supply_generalSchema_data, output_format):
+    """ test combined output is written as one file per partition value
+    with a manifest, and single partitions can be read back """
+    if output_format == 'parquet':
+        pytest.importorskip('pyarrow')
+    csv_loc = tmpdir.mkdir('csvs')
+    for i, df in enumerate(supply_generalSchema_data):
+        df.to_csv(str(csv_loc.join(f'test_csv_{i}.csv')), index=False)
+
+    c = Combine('general', str(csv_loc), output_format=output_format, partition_by='Provider Name')
+    c.combine_csvs()
+    out_dir = tmpdir.mkdir('out')
+    c.write_combined_csv(str(out_dir))
+    written = [p.basename for p in out_dir.listdir()]
+    assert len(written) == 1 and written[0].startswith('AggIns_combined_csvs_')
+    path = str(out_dir.join(written[0]))
+
+    with open(os.path.join(path, '_manifest.json')) as f:
+        manifest = json.load(f)
+    providers = c.master_df['Provider Name']
+    assert manifest['rows'] == c.total_rows
+    assert [p['value'] for p in manifest['partitions']] == sorted(providers.unique())
+    for p in manifest['partitions']:
+        assert p['rows'] == (providers == p['value']).sum()
+        assert os.path.exists(os.path.join(path, p['path']))
+
+    value = manifest['partitions'][0]['value']
+    part = read_partitions(path, [value])
+    assert len(part) == (providers == value).sum()
+    assert set(part['Provider Name']) == {value}
+    assert len(read_partitions(path)) == c.total_rows
+
+    # percent-encoded partition directories can be pruned by their column name
+    for text in [f'Provider Name={value}', f'Provider%20Name={value}']:
+        found = discover_csvs(path, (f'*.{output_format}',), recursive=True,
+                              filters=[PartitionFilter.parse(text)])
+        assert found == [os.path.join(path, manifest['partitions'][0]['path'])]
+
+    # streamed output is partitioned the same way
+    stream_path = str(tmpdir.join('streamed'))
+    s = Combine('general', str(csv_loc), output_format=output_format, partition_by='Provider Name')
+    s.stream_combined_csv(stream_path)
+    with open(os.path.join(stream_path, '_manifest.json')) as f:
+        assert json.load(f)['partitions'] == manifest['partitions']
+
+    # rewriting partitioned output, from its parent or its own path,
+    # replaces it whole without leaving stale partitions behind
+    c.master_df = c.master_df[providers == value]
+    for location in [str(out_dir), path]:
+        c.write_combined_csv(location)
+        assert [p.basename for p in out_dir.listdir()] == written
+        partitions = [p for p in os.listdir(path) if p != '_manifest.json']
+        assert partitions == [os.path.dirname(manifest['partitions'][0]['path'])]
+        assert len(read_partitions(path)) == (providers == value).sum()
+    with pytest.raises(ValueError, match='is partitioned output'):
+        Combine('general', str(csv_loc)).write_combined_csv(path)
+
+def test_combine_csvs_cache(tmpdir, supply_generalSchema_data, monkeypatch):
+    """ test unchanged csvs are loaded from the cache on later runs, and
+    changed csvs or a changed schema are validated again """
+
+    csv_loc = tmpdir.mkdir('csvs')
+    for i, df in enumerate(supply_generalSchema_data):
+        df.to_csv(str(csv_loc.join(f'test_csv_{i}.csv')), index=False)
+    cache_dir = str(tmpdir.join('cache'))
+
+    first = Combine('general', str(csv_loc), cache_dir=cache_dir)
+    first.combine_csvs()
+    second = Combine('general', str(csv_loc), cache_dir=cache_dir)
+    second.combine_csvs()
+
+    assert first.total_csvs_cached == 0
+    assert second.total_csvs_cached == 6
+    pd.testing.assert_frame_equal(first.master_df, second.master_df)
+    assert first.total_rows_w_errors == second.total_rows_w_errors
+    assert first.distinct_cols_w_errors == second.distinct_cols_w_errors
+
+    # rewrite one csv with new content
+    supply_generalSchema_data[0].iloc[:2].to_csv(str(csv_loc.join('test_csv_0.csv')), index=False)
+    third = Combine('general', str(csv_loc), cache_dir=cache_dir)
+    third.combine_csvs()
+    assert third.total_csvs_cached == 5
+    assert len(third.master_df) == len(first.master_df) - 1
+
+    # changing a validation, even one in a module level per-value check,
+    # invalidates every entry
+    def format_zipcode(x):
+        return x
+    monkeypatch.setitem(schema.VALUE_CHECKS, 'zipcode', format_zipcode)
+    schema.compile_schema.cache_clear()
+    schema.configure_value_caches()
+    try:
+        fourth = Combine('general', str(csv_loc), cache_dir=cache_dir)
+        assert fourth.plan.version != third.plan.version
+        fourth.combine_csvs()
+        assert fourth.total_csvs_cached == 0
+        assert '787651089' in fourth.master_df['Zipcode'].tolist()
+    finally:
+        monkeypatch.undo()
+        schema.compile_schema.cache_clear()
+        schema.configure_value_caches()
+
+@pytest.mark.parametrize('output_format', ['parquet', 'feather'])
+def test_write_combined_columnar(tmpdir, supply_generalSchema_data, output_format):
+    """ test combined output can be written as typed, compressed
+    parquet or feather in row groups """
+    pa = pytest.importorskip('pyarrow')
+
+    csv_loc = tmpdir.mkdir('csvs')
+    for i, df in enumerate(supply_generalSchema_data):
+        df.to_csv(str(csv_loc.join(f'test_csv_{i}.csv')), index=False)
+
+    c = Combine('general', str(csv_loc), output_format=output_format,
+                compression='zstd', row_group_size=5)
+    c.combine_csvs()
+    c.write_combined_csv(str(tmpdir))
+    output_loc = [str(p) for p in tmpdir.listdir() if p.isfile()][0]
+    assert output_loc.endswith('.' + output_format)
+
+    if output_format == 'parquet':
+        import pyarrow.parquet as pq
+        meta = pq.ParquetFile(output_loc).metadata
+        assert meta.num_row_groups == 3
+        assert meta.row_group(0).column(0).compression == 'ZSTD'
+        result = pd.read_parquet(output_loc)
+    else:
+        result = pd.read_feather(output_loc)
+
+    assert result.columns.tolist() == c.schema_cols
+    assert result['Cost Per Ad Click'].dtype == 'float64'
+    assert result['Zipcode'].tolist() == c.master_df['Zipcode'].tolist()
+    assert len(result) == 13
+
 def test_write_combined_csv_single(tmpdir, supply_generalSchema_data):
     """ test combined csv is successfully written to working directory"""
 
@@ -1,6 +1,12 @@
+import subprocess
+import sys
+
 import pytest
+import numpy as np
+import pandas as pd
 
-from aggregator.utilities import schema_map, SchemaNotFoundError
+from aggregator.utilities import (schema_map, register_schema, df_memory_mb, compact_dtypes,
+                                  detect_compression, SchemaNotFoundError)
 from aggregator.schema import GeneralSchema
 
 def test_schema_map_instantiate():
@@ -14,3 +20,58 @@ def test_schema_map_raise_exception():
     """ test exception is raised when non-present class specified """
     with pytest.raises(SchemaNotFoundError, match=r'Schema obj for string not_found not found'):
         schema_map('not_found')
+
+def test_df_memory_mb():
+    """ test dataframe memory is reported in megabytes """
+    df = pd.DataFrame({'a':np.zeros(2**17)})
+    assert df_memory_mb(df) >= 1.0
+    assert df_memory_mb(df.iloc[:0]) < 0.01
+
+def test_compact_dtypes():
+    """ test columns get compact dtypes from their schema types """
+    pytest.importorskip('pyarrow')
+    df = pd.DataFrame({
+        'name':['a', 'b', 'a', 'a'],
+        'id':['x1', 'x2', 'x3', np.nan],
+        'cost':[1.5, '2', 3, 4.0],
+        'extra':['1', '2', '3', '4'],
+    })
+    types = {'name':str, 'id':str, 'cost':float}
+    result = compact_dtypes(df, types, string_dtype='pyarrow')
+    assert result['name'].dtype == 'category'
+    assert result['id'].dtype == pd.StringDtype('pyarrow')
+    assert result['cost'].tolist() == [1.5, 2.0, 3.0, 4.0]
+    assert result['extra'].dtype == object
+    assert df['cost'].dtype == object
+
+def test_register_schema_lazy():
+    """ test schemas registered by path are imported on first use """
+    register_schema('lazy_test', 'tests.conftest:TestSchema')
+    s = schema_map('lazy_test')
+    assert type(s).__name__ == 'TestSchema'
+    assert schema_map('lazy_test') is not s
+
+def test_register_schema_decorator():
+    """ test schemas can be registered with a class decorator """
+    @register_schema('decorated_test')
+    class DecoratedSchema(GeneralSchema):
+        """ test schema """
+    assert type(schema_map('decorated_test')) == DecoratedSchema
+
+def test_cli_import_excludes_tests():
+    """ test importing the cli does not import test only schemas,
+    pytest or validators """
+    code = 'import sys, aggregator.aggregate; print(sorted(sys.modules))'
+    out = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE,
+                         universal_newlines=True, check=True).stdout
+    for module in ['tests.conftest', 'pytest', 'validators']:
+        assert f"'{module}'" not in out
+
+def test_zstd_requires_newer_pandas(tmpdir, monkeypatch):
+    """ test zstd input on pandas older than 1.4 raises a clear error """
+    zstd_loc = str(tmpdir.join('test.csv'))
+    with open(zstd_loc, 'wb') as f:
+        f.write(b'\x28\xb5\x2f\xfd' + b'\x00'*4)
+    monkeypatch.setattr(pd, '__version__', '1.1.0')
+    with pytest.raises(RuntimeError, match=r'requires pandas >= 1.4, pandas 1.1.0 is installed'):
+        detect_compression(zstd_loc)
@@ -6,6 +6,7 @@ import pandas as pd
 
 from aggregator.aggregate import AggCSV
 from aggregator.schema import Validation, GeneralSchema, SchemaTypeNotDeclared
+from aggregator.schema import configure_value_caches, value_cache_info, compile_schema
 
 def dummy_df():
     """ empty df """
@@ -188,3 +189,116 @@ def test_valid_zipcode():
         val = gs.valid_zipcode(*data)
         print(val, number)
         assert val == validity[i]
+
+def test_vectorized_validations_match_per_cell():
+    """ test whole-column validations return the same values
+    and errors as their per-cell versions """
+    values = ['(512)239-9784', '2399784', '399754', 5122399784, '78752-2534',
+              787651089, ' \n', 'n/a', 'NULL', '0', '', np.nan, False, 0.0,
+              '  22 55 drive ', "o'neil st", '$1,5.00', '1.2.3', 'abc']
+    s = pd.Series(values, dtype=object)
+
+    gs = GeneralSchema()
+    cols = {k:v for k,v in gs.get_schema_attrs()}
+    checks = [(gs.validate_type, cols['provider_name']),
+              (gs.validate_type, cols['cost_per_ad_click']),
+              (gs.validate_null, cols['provider_name']),
+              (gs.validate_null, cols['phone_number']),
+              (Validation.upper_campaign_id, cols['campaign_id']),
+              (Validation.valid_phone_number, cols['phone_number']),
+              (Validation.valid_zipcode, cols['zipcode'])]
+
+    for validation, col in checks:
+        expected, expected_mask = gs._cell_apply(validation, s, col)
+        cleaned, mask = gs.get_vectorized(validation)(s, col)
+        assert mask.tolist() == expected_mask.tolist()
+        assert [str(x) for x in cleaned] == [str(x) for x in expected]
+
+    # standardize_address is only validated cell by cell
+    assert gs.get_vectorized(Validation.standardize_address) is None
+
+    costs = pd.Series([1.0, 0.0, False, 22.5, np.nan], dtype=object)
+    col = cols['cost_per_ad_click']
+    expected, expected_mask = gs._cell_apply(Validation.valid_cost_per_ad_click, costs, col)
+    cleaned, mask = gs.vec_valid_cost_per_ad_click(costs, col)
+    assert mask.tolist() == expected_mask.tolist()
+    assert [str(x) for x in cleaned] == [str(x) for x in expected]
+
+def test_validate_series_chunks_keyed_by_index():
+    """ test errors are attributed to index labels when a column
+    is validated in chunks and out of order """
+    s = pd.Series(['78752', '787', '78752-2534', 'abc', '787522534'],
+                  index=[10, 11, 12, 13, 14])
+
+    gs = GeneralSchema()
+    col = [v for k,v in gs.get_schema_attrs() if k == 'zipcode'][0]
+    for chunk in [s.iloc[3:], s.iloc[:3]]:
+        gs.validate_series(chunk, col, 'csv_path')
+
+    assert gs.get_rows_w_errors() == {11, 13}
+    assert [err[2:5] for err in gs.get_errors()] == [
+        [13, 'valid_zipcode', 'abc'], [11, 'valid_zipcode', '787']]
+
+def test_error_count_single_value_row():
+    """ test a single validated value is tracked by its row label """
+    gs = GeneralSchema()
+    col = [v for k,v in gs.get_schema_attrs() if k == 'zipcode'][0]
+    df = pd.DataFrame({'Zipcode':['1', '787']}, index=[7, 42])
+
+    assert gs.valid_zipcode('787', col, 'csv_path', df, row=42) == False
+    assert gs.valid_zipcode('78752', col, 'csv_path', df, row=7) == '78752'
+    assert gs.get_rows_w_errors() == {42}
+
+def test_schema_version(supply_testSchema):
+    """ test schema version is stable and differs between schemas """
+    assert GeneralSchema().schema_version() == GeneralSchema().schema_version()
+    assert GeneralSchema().schema_version() != supply_testSchema().schema_version()
+
+def test_value_caches():
+    """ test per-value checks are memoized with hit/miss counters """
+    configure_value_caches(maxsize=2)
+    gs = GeneralSchema()
+    col = [v for k,v in gs.get_schema_attrs() if k == 'redirect_link'][0]
+    for link in ['a.com/1', 'a.com/2', 'b.com', 'wont work']:
+        gs.valid_redirect_link(link, col)
+
+    info = value_cache_info()['domain']
+    assert (info.hits, info.misses, info.maxsize, info.currsize) == (1, 3, 2, 2)
+
+    s = pd.Series(['a.com/1', 'wont work', 'b.com', np.nan], dtype=object)
+    cleaned, mask = gs.vec_valid_redirect_link(s, col)
+    expected, expected_mask = gs._cell_apply(Validation.valid_redirect_link, s, col)
+    assert mask.tolist() == expected_mask.tolist() == [False, True, False, True]
+    assert cleaned.tolist() == expected.tolist()
+    configure_value_caches()
+
+def test_validate_series_dedup():
+    """ test distinct values are validated once and errors are
+    attributed to every row holding a failed value """
+    s = pd.Series(['787', '78752', np.nan, '787', '78752', np.nan], index=list('abcdef'))
+    gs = GeneralSchema()
+    col = [v for k,v in gs.get_schema_attrs() if k == 'zipcode'][0]
+
+    configure_value_caches()
+    cleaned = gs.validate_series(s, col, 'csv_path', dedup=True)
+
+    assert value_cache_info()['zipcode'].misses == 3
+    assert cleaned.tolist() == [False, '78752', False, False, '78752', False]
+    assert gs.get_rows_w_errors() == {'a', 'c', 'd', 'f'}
+    assert [err[2:4] for err in gs.get_errors()] == [
+        ['c', 'validate_null'], ['f', 'validate_null'],
+        ['a', 'valid_zipcode'], ['c', 'valid_zipcode'],
+        ['d', 'valid_zipcode'], ['f', 'valid_zipcode']]
+
+def test_compile_schema():
+    """ test schema class is compiled once into an immutable plan """
+    plan = compile_schema(GeneralSchema)
+    assert GeneralSchema().get_plan() is plan
+    assert [c.name for c in plan.columns] == [v['name'] for k,v in GeneralSchema().get_schema_attrs()]
+
+    zipcode = plan.by_name['Zipcode']
+    assert (zipcode.type, zipcode.nullable) == (str, False)
+    assert [step.rule for step in zipcode.steps] == ['validate_type', 'validate_null', 'valid_zipcode']
+    assert zipcode.steps[-1].vec == Validation.vec_valid_zipcode
+    with pytest.raises(TypeError):
+        zipcode.col['nullable'] = True